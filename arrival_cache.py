@@ -0,0 +1,136 @@
+"""
+Short-lived cache of LTA bus arrival responses shared by every user
+"""
+import asyncio
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class _Flight:
+    """
+    An upstream request in progress that other threads can wait on
+    """
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ArrivalCache:
+    """
+    TTL cache with LRU eviction. Concurrent misses for the same key share one upstream call (single flight), between
+    threads with get or between coroutines on one event loop with get_async.
+    """
+    def __init__(self, ttl, max_size):
+        """
+        :param float ttl: Seconds that a response stays fresh
+        :param int max_size: Maximum number of keys kept before the least recently used is evicted
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._flights = dict()
+        # key -> asyncio.Task fetching it, only used on the event loop's thread
+        self._tasks = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def get(self, key, fetch):
+        """
+        Get a fresh value from the cache, or fetch it if it is missing or expired
+        :param key: Cache key, e.g. bus stop code
+        :param fetch: Function called with the key to get the value from upstream
+        :return: The cached or fetched value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch(key)
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            self.put(key, flight.value)
+            return flight.value
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def get_async(self, key, fetch):
+        """
+        Same as get, for coroutines on one event loop. The fetch runs as its own task, so a caller that is cancelled,
+        e.g. after a timeout, does not cancel it for the others and the value is still cached when it arrives.
+        :param key: Cache key, e.g. bus stop code
+        :param fetch: Coroutine function called with the key to get the value from upstream
+        :return: The cached or fetched value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            task = self._tasks.get(key)
+            if task is None:
+                task = self._tasks[key] = asyncio.ensure_future(self._fetch_async(key, fetch))
+                self.misses += 1
+            else:
+                self.shared += 1
+        return await asyncio.shield(task)
+
+    async def get_many_async(self, keys, fetch, timeout=None):
+        """
+        get_async for every key at the same time
+        :param list keys: Cache keys
+        :param fetch: Coroutine function called with a key to get its value from upstream
+        :param float timeout: Seconds to wait for each key, a key that takes longer gets asyncio.TimeoutError
+        :return: List of values, or the exception raised, in the same order as keys
+        """
+        return await asyncio.gather(*(asyncio.wait_for(self.get_async(key, fetch), timeout) for key in keys),
+                                    return_exceptions=True)
+
+    async def _fetch_async(self, key, fetch):
+        try:
+            value = await fetch(key)
+            self.put(key, value)
+            return value
+        finally:
+            del self._tasks[key]
+
+    def put(self, key, value):
+        """
+        Store a value fetched by the caller
+        :param key: Cache key, e.g. bus stop code
+        :param value: Value to keep for ttl seconds
+        """
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,73 @@
+"""
+Decodes the arrival times of a BusArrivalv2 response into minutes from one reference time
+"""
+import logging
+from calendar import timegm
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# NextBus, NextBus2 and NextBus3 of each service
+NEXT_BUSES = ('NextBus', 'NextBus2', 'NextBus3')
+
+# 'YYYY-MM-DD' + '+HH:MM' to the epoch seconds of that midnight, there are only ever one or two dates in use
+_midnights = dict()
+
+
+def parse_timestamp(timestamp):
+    """
+    Parse an ISO 8601 timestamp with a fixed UTC offset, as DataMall returns them
+    :param str timestamp: e.g. '2021-05-01T10:03:21+08:00'
+    :return: Seconds since the epoch
+    """
+    if len(timestamp) != 25 or timestamp[10] != 'T' or timestamp[13] != ':' or timestamp[16] != ':':
+        raise ValueError('Invalid arrival time {!r}'.format(timestamp))
+    key = timestamp[:10] + timestamp[19:]
+    midnight = _midnights.get(key)
+    if midnight is None:
+        offset = (int(timestamp[20:22]) * 60 + int(timestamp[23:25])) * 60
+        if timestamp[19] == '-':
+            offset = -offset
+        elif timestamp[19] != '+':
+            raise ValueError('Invalid arrival time {!r}'.format(timestamp))
+        midnight = timegm((int(timestamp[:4]), int(timestamp[5:7]), int(timestamp[8:10]), 0, 0, 0)) - offset
+        if len(_midnights) > 64:
+            _midnights.clear()
+        _midnights[key] = midnight
+    return midnight + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+
+
+def decode_service(service, now):
+    """
+    :param dict service: One service of a BusArrivalv2 response
+    :param float now: Reference time in seconds since the epoch
+    :return: [(minutes or None if there is no estimate, load, feature)] for the next 3 buses
+    """
+    buses = list()
+    for next_bus in NEXT_BUSES:
+        bus = service[next_bus]
+        estimated_arrival = bus['EstimatedArrival']
+        minutes = round((parse_timestamp(estimated_arrival) - now) / 60.0) if estimated_arrival else None
+        buses.append((minutes, bus['Load'], bus['Feature']))
+    return buses
+
+
+def decode_arrivals(services, now=None):
+    """
+    Work out the minutes until every bus of every service arrives, all from the same reference time
+    :param services: Services of a BusArrivalv2 response
+    :param float now: Reference time in seconds since the epoch, defaults to the current time
+    :return: List of (bus number, result of decode_service) in the order of the services. Services with an invalid
+    arrival time are left out.
+    """
+    if now is None:
+        now = time()
+    decoded = list()
+    for service in services:
+        try:
+            decoded.append((service['ServiceNo'], decode_service(service, now)))
+        except ValueError:
+            # One bad service should not fail the whole bus stop
+            logger.debug('Cannot decode service %s: %s', service.get('ServiceNo'), service)
+            continue
+    return decoded
@@ -0,0 +1,107 @@
+"""
+asyncio client for the LTA DataMall API, used when IO_MODE=async.
+
+One event loop runs on a background thread and every DataMall call is a coroutine on it, so a thousand bus stops
+being fetched at once wait on sockets instead of each holding a thread. Handlers on the dispatcher's threads hand
+their calls to the loop with EventLoopThread.run() and still block until the call returns or times out, so this only
+helps the paths that fetch many bus stops at once, e.g. the favourites dashboard and scheduled messages. A single bus
+stop or the train alerts cost the same thread wait as with the blocking client.
+"""
+import asyncio
+import concurrent.futures
+import random
+import threading
+from time import perf_counter
+
+import aiohttp
+
+import metrics
+
+from datamall import BASE_URL, TIMEOUTS, DEFAULT_TIMEOUT, RETRY_STATUS, DataMallError
+
+
+class EventLoopThread:
+    """
+    An asyncio event loop running forever on a daemon thread
+    """
+    def __init__(self, name='asyncio'):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine, timeout=None):
+        """
+        Run a coroutine on the loop and wait for its result from another thread
+        :param coroutine: Coroutine object
+        :param float timeout: Seconds to wait for the result
+        :return: Result of the coroutine
+        :raises concurrent.futures.TimeoutError: If the result is not ready in time, the coroutine is cancelled
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+
+class AsyncDataMallClient:
+    """
+    Same timeouts, retries and latency metrics as datamall.DataMallClient, on one aiohttp session
+    """
+    def __init__(self, account_key, pool_size=64, max_retries=2, backoff=0.25):
+        """
+        :param str account_key: LTA DataMall account key
+        :param int pool_size: Maximum number of open connections
+        :param int max_retries: Number of retries after the first attempt
+        :param float backoff: Base delay in seconds before the first retry, doubled for each retry after
+        """
+        self.account_key = account_key or ''
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._session = None
+
+    def _get_session(self):
+        # Created on first use, since the session belongs to the loop it is created on
+        if self._session is None:
+            self._session = aiohttp.ClientSession(headers={'AccountKey': self.account_key},
+                                                  connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self._session
+
+    async def get(self, endpoint, params=None):
+        """
+        Call a DataMall endpoint
+        :param str endpoint: Endpoint name, e.g. 'BusArrivalv2'
+        :param dict params: Query parameters
+        :return: Decoded JSON response
+        """
+        connect_timeout, read_timeout = TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        for attempt in range(self.max_retries + 1):
+            start = perf_counter()
+            try:
+                async with self._get_session().get(BASE_URL + endpoint, params=params, timeout=timeout) as response:
+                    if response.status in RETRY_STATUS:
+                        raise DataMallError('{} returned {}'.format(endpoint, response.status))
+                    response.raise_for_status()
+                    data = await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError, DataMallError):
+                self._record(endpoint, perf_counter() - start, error=True, retry=attempt < self.max_retries)
+                if attempt == self.max_retries:
+                    raise
+                # Full jitter so that retries of many coroutines do not arrive together
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            except Exception:
+                self._record(endpoint, perf_counter() - start, error=True)
+                raise
+            else:
+                self._record(endpoint, perf_counter() - start)
+                return data
+
+    def _record(self, endpoint, seconds, error=False, retry=False):
+        metrics.datamall_seconds.observe(endpoint, seconds)
+        if error:
+            metrics.datamall_errors.inc(endpoint)
+        if retry:
+            metrics.datamall_retries.inc(endpoint)
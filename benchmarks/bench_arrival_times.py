@@ -0,0 +1,69 @@
+"""
+Compare decoding a BusArrivalv2 response with strptime for every bus, as the bot used to, against decode_arrivals.
+Run from the repository root: python benchmarks/bench_arrival_times.py
+"""
+import os
+import sys
+import random
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from arrival_times import decode_arrivals, NEXT_BUSES
+
+
+def legacy_time_difference(arrival_time):
+    """
+    How the bot used to work out the minutes until one bus arrives
+    :param str arrival_time: EstimatedArrival of a bus, e.g. '2021-05-01T10:03:21+08:00'
+    :return: Difference in time in minutes from the current Singapore time
+    """
+    arrival_time = datetime.strptime(arrival_time.split('+')[0].replace('T', ' '), '%Y-%m-%d %H:%M:%S')
+    return round(((arrival_time - (datetime.utcnow() + timedelta(hours=8))).total_seconds() / 60.0))
+
+
+def make_services(count):
+    """
+    :return: Services like a BusArrivalv2 response of a busy bus stop, arriving in the next hour
+    """
+    now = datetime.utcnow() + timedelta(hours=8)
+    services = list()
+    for service_no in range(count):
+        service = {'ServiceNo': str(service_no + 1)}
+        for next_bus in NEXT_BUSES:
+            arrival = now + timedelta(seconds=random.randint(0, 3600))
+            service[next_bus] = {'EstimatedArrival': arrival.strftime('%Y-%m-%dT%H:%M:%S+08:00'),
+                                 'Load': random.choice(('SEA', 'SDA', 'LSD')), 'Feature': 'WAB'}
+        services.append(service)
+    return services
+
+
+def legacy_loop(services):
+    return [(service['ServiceNo'], [(legacy_time_difference(service[next_bus]['EstimatedArrival']),
+                                     service[next_bus]['Load'], service[next_bus]['Feature'])
+                                    for next_bus in NEXT_BUSES])
+            for service in services]
+
+
+def main():
+    random.seed(0)
+    responses = [make_services(30) for _ in range(100)]
+
+    # Both give the same minutes, give or take the rounding of different reference times
+    for services in responses:
+        for (_, old), (_, new) in zip(legacy_loop(services), decode_arrivals(services)):
+            assert all(abs(a[0] - b[0]) <= 1 for a, b in zip(old, new))
+
+    print('{} responses of {} services, 3 buses each'.format(len(responses), len(responses[0])))
+    baseline = None
+    for name, function in (('strptime per bus', legacy_loop),
+                           ('decode_arrivals', decode_arrivals)):
+        seconds = timeit.timeit(lambda: [function(services) for services in responses], number=10)
+        per_response = seconds / (10 * len(responses)) * 1000
+        baseline = baseline or per_response
+        print('{:<28}{:>9.3f} ms/response {:>8.1f}x'.format(name, per_response, baseline / per_response))
+
+
+if __name__ == '__main__':
+    main()
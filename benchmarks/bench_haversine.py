@@ -0,0 +1,55 @@
+"""
+Compare the scalar haversine loop that nearest_locations used to run against the vectorised and grid lookups.
+Run from the repository root: python benchmarks/bench_haversine.py
+"""
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bus_index import BusStopRegistry
+from geo import haversine
+
+
+def scalar_loop(registry, latitude, longitude, radius):
+    found = list()
+    for bus_stop in registry:
+        distance = haversine(latitude, longitude, bus_stop.latitude, bus_stop.longitude)
+        if distance <= radius:
+            found.append((distance, bus_stop))
+    found.sort(key=lambda x: x[0])
+    return found
+
+
+def vectorised(registry, latitude, longitude, radius):
+    distances = registry.distances(latitude, longitude)
+    return sorted((distances[index], index) for index in (distances <= radius).nonzero()[0])
+
+
+def main():
+    registry = BusStopRegistry.from_file()
+    random.seed(0)
+    locations = [(random.uniform(1.27, 1.44), random.uniform(103.68, 103.98)) for _ in range(200)]
+
+    timings = (('Scalar haversine loop', scalar_loop),
+               ('Vectorised haversine', vectorised),
+               ('Spatial grid + vectorised', lambda r, lat, lon, radius: r.within(lat, lon, radius)))
+
+    print('{} bus stops, {} locations, 350m radius'.format(len(registry), len(locations)))
+    baseline = None
+    for name, function in timings:
+        seconds = timeit.timeit(lambda: [function(registry, lat, lon, 0.35) for lat, lon in locations], number=3)
+        per_query = seconds / (3 * len(locations)) * 1000
+        baseline = baseline or per_query
+        print('{:<28}{:>9.3f} ms/query {:>8.1f}x'.format(name, per_query, baseline / per_query))
+
+    seconds = timeit.timeit(lambda: registry.distances([lat for lat, _ in locations],
+                                                      [lon for _, lon in locations]), number=3)
+    print('{:<28}{:>9.3f} ms/query (all {} locations in one call)'.format(
+        'Vectorised batch', seconds / (3 * len(locations)) * 1000, len(locations)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Concurrent, rate-limited delivery of many Telegram messages
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+from telegram.error import RetryAfter, TimedOut, NetworkError, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall and 1 message per second to the same chat
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+
+
+class RateLimiter:
+    """
+    Spaces out sends to stay under a global rate and a minimum interval per chat
+    """
+    def __init__(self, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self._interval = 1.0 / rate
+        self._per_chat_interval = per_chat_interval
+        self._next_send = 0.0
+        self._next_chat_send = dict()
+        self._lock = threading.Lock()
+
+    def reserve(self, chat_id, deadline=None):
+        """
+        Reserve a send slot for a chat
+        :param chat_id: Chat that the message is sent to
+        :param float deadline: time.monotonic() by which the message has to be sent
+        :return: Seconds to wait before sending, or None without reserving anything if the slot is past the deadline
+        """
+        with self._lock:
+            now = monotonic()
+            global_slot = max(now, self._next_send)
+            slot = max(global_slot, self._next_chat_send.get(chat_id, 0.0))
+            # A message that will be skipped must not push later messages back
+            if deadline is not None and slot >= deadline:
+                return None
+            self._next_send = global_slot + self._interval
+            self._next_chat_send[chat_id] = slot + self._per_chat_interval
+            # Forget chats whose interval has passed so the dict does not grow forever
+            if len(self._next_chat_send) > 10000:
+                self._next_chat_send = {chat: time for chat, time in self._next_chat_send.items() if time > now}
+            return slot - now
+
+    def wait(self, chat_id):
+        """
+        Block until a message can be sent to the chat
+        :param chat_id: Chat that the message is sent to
+        """
+        delay = self.reserve(chat_id)
+        if delay > 0:
+            sleep(delay)
+
+
+class BroadcastResult:
+    """
+    Number of messages sent, failed and skipped because the deadline passed
+    """
+    __slots__ = ('sent', 'failed', 'skipped')
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def __repr__(self):
+        return 'BroadcastResult(sent={}, failed={}, skipped={})'.format(self.sent, self.failed, self.skipped)
+
+
+class Broadcaster:
+    """
+    Sends messages from a pool of worker threads through a shared RateLimiter
+    """
+    def __init__(self, workers=8, rate_limiter=None):
+        # Each worker holds one of the bot's connections while sending
+        self.workers = workers
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast')
+
+    def send(self, bot, messages, deadline=None, on_sent=None):
+        """
+        Send messages concurrently and wait for all of them
+        :param bot: telegram.Bot
+        :param messages: Iterable of (chat_id, dict of keyword arguments for bot.send_message)
+        :param float deadline: time.monotonic() after which unsent messages are skipped
+        :param on_sent: Function called with the chat_id after each successful send
+        :return: BroadcastResult
+        """
+        result = BroadcastResult()
+        lock = threading.Lock()
+
+        def deliver(chat_id, kwargs):
+            outcome = self._deliver(bot, chat_id, kwargs, deadline)
+            with lock:
+                setattr(result, outcome, getattr(result, outcome) + 1)
+            if outcome == 'sent' and on_sent is not None:
+                on_sent(chat_id)
+
+        futures = [self._executor.submit(deliver, chat_id, kwargs) for chat_id, kwargs in messages]
+        for future in futures:
+            future.result()
+        return result
+
+    def _deliver(self, bot, chat_id, kwargs, deadline):
+        for attempt in range(3):
+            delay = self.rate_limiter.reserve(chat_id, deadline)
+            if delay is None:
+                return 'skipped'
+            if delay > 0:
+                sleep(delay)
+            try:
+                bot.send_message(chat_id=chat_id, **kwargs)
+                return 'sent'
+            except RetryAfter as e:
+                logger.info('Rate limited by Telegram for %ss', e.retry_after)
+                sleep(e.retry_after)
+            except TimedOut:
+                # The message may still have been delivered, so do not send it twice
+                return 'failed'
+            except NetworkError:
+                sleep(0.5 * 2 ** attempt)
+            except TelegramError as e:
+                # e.g. the user has blocked the bot
+                logger.info('Could not send message to %s: %s', chat_id, e)
+                return 'failed'
+        return 'failed'
+
+
+broadcaster = Broadcaster()
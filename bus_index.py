@@ -0,0 +1,262 @@
+"""
+In-memory indexes of the bus data files, loaded once and shared by every handler
+"""
+import numpy as np
+
+from geo import SpatialGrid, haversine_many
+from stop_search import StopSearchIndex
+
+BUS_STOPS_FILE = 'bus_stops.txt'
+BUS_ROUTES_FILE = 'bus_routes.txt'
+
+
+def to_minutes(timing):
+    """
+    Convert a 'HHMM' timing from bus_routes.txt into minutes after midnight
+    :param str timing: 'HHMM', or '-' if the bus does not run on that day
+    :return: Minutes after midnight or None
+    """
+    if len(timing) != 4 or not timing.isdigit():
+        return None
+    return int(timing[:2]) * 60 + int(timing[2:])
+
+
+def read_bus_stops(path=BUS_STOPS_FILE):
+    """
+    Parse bus_stops.txt
+    :param str path: Path of bus_stops.txt
+    :return: Generator of (bus stop code, road name, description, latitude, longitude)
+    """
+    with open(path, 'r') as r:
+        for line in r:
+            attributes = line.rstrip('\n').split(' | ', 4)
+            if len(attributes) == 5:
+                yield attributes[0], attributes[1], attributes[2], float(attributes[3]), float(attributes[4])
+
+
+def read_bus_routes(path=BUS_ROUTES_FILE):
+    """
+    Parse bus_routes.txt
+    :param str path: Path of bus_routes.txt
+    :return: Generator of (bus number, direction, bus stop code, bus stop name, weekday first/last bus,
+    Saturday first/last bus, Sunday first/last bus) with timings in minutes after midnight or None
+    """
+    with open(path, 'r') as r:
+        for line in r:
+            attributes = line.rstrip('\n').split(' | ', 9)
+            if len(attributes) == 10:
+                yield tuple(attributes[:4]) + tuple(map(to_minutes, attributes[4:10]))
+
+
+class BusStop:
+    """
+    A single bus stop from bus_stops.txt
+    """
+    __slots__ = ('code', 'road_name', 'description', 'latitude', 'longitude')
+
+    def __init__(self, code, road_name, description, latitude, longitude):
+        self.code = code
+        self.road_name = road_name
+        self.description = description
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def __repr__(self):
+        return 'BusStop({!r}, {!r}, {!r})'.format(self.code, self.road_name, self.description)
+
+
+class BusStopRegistry:
+    """
+    All the bus stops, in file order, with O(1) lookup by bus stop code and a spatial grid for nearby stops.
+    Coordinates are also kept as contiguous float64 arrays in radians for vectorised distance calculations.
+    """
+    def __init__(self, bus_stops):
+        """
+        :param bus_stops: Iterable of BusStop
+        """
+        self._bus_stops = tuple(bus_stops)
+        self._by_code = {bus_stop.code: bus_stop for bus_stop in self._bus_stops}
+        self.latitudes = np.radians(np.array([bus_stop.latitude for bus_stop in self._bus_stops], dtype=np.float64))
+        self.longitudes = np.radians(np.array([bus_stop.longitude for bus_stop in self._bus_stops], dtype=np.float64))
+        self._grid = SpatialGrid(self.latitudes, self.longitudes)
+        self._search_index = StopSearchIndex(self._bus_stops)
+
+    @classmethod
+    def from_file(cls, path=BUS_STOPS_FILE):
+        """
+        :param str path: Path of bus_stops.txt
+        :return: BusStopRegistry
+        """
+        return cls(BusStop(*row) for row in read_bus_stops(path))
+
+    def get(self, bus_stop_code):
+        """
+        :param str bus_stop_code: Bus Stop Code of bus stop
+        :return: BusStop or None if the bus stop code does not exist
+        """
+        return self._by_code.get(bus_stop_code)
+
+    def within(self, latitude, longitude, radius):
+        """
+        :param float latitude: Latitude of user's location
+        :param float longitude: Longitude of user's location
+        :param float radius: Search radius in kilometers
+        :return: List of (distance, BusStop) within the radius, nearest first
+        """
+        return self._with_bus_stops(*self._grid.within(latitude, longitude, radius))
+
+    def nearest(self, latitude, longitude, k):
+        """
+        :param float latitude: Latitude of user's location
+        :param float longitude: Longitude of user's location
+        :param int k: Number of bus stops to return
+        :return: List of the k nearest (distance, BusStop), nearest first
+        """
+        return self._with_bus_stops(*self._grid.nearest(latitude, longitude, k))
+
+    def distances(self, latitudes, longitudes):
+        """
+        Distances from one or many locations to every bus stop, in file order
+        :param latitudes: Latitude in degrees, a float or a 1-d array
+        :param longitudes: Longitude in degrees, a float or a 1-d array
+        :return: numpy.ndarray of distances in kilometers, shape (stops,) or (locations, stops)
+        """
+        return haversine_many(latitudes, longitudes, self.latitudes, self.longitudes)
+
+    def search(self, query, limit=20, compat=False):
+        """
+        Find bus stops whose road name or description matches a free-text location
+        :param str query: User's message
+        :param int limit: Maximum number of bus stops to return
+        :param bool compat: Use the original unranked 75% ratio/substring scan instead of the ranked trigram search
+        :return: List of BusStop
+        """
+        if compat:
+            # The original scan checked the limit before adding, so it let one extra bus stop in
+            return self._search_index.search_compat(query, limit + 1)
+        return self._search_index.search(query, limit)
+
+    def _with_bus_stops(self, distances, indices):
+        return [(distance, self._bus_stops[index]) for distance, index in zip(distances.tolist(), indices.tolist())]
+
+    def __contains__(self, bus_stop_code):
+        return bus_stop_code in self._by_code
+
+    def __iter__(self):
+        return iter(self._bus_stops)
+
+    def __len__(self):
+        return len(self._bus_stops)
+
+
+def service_window(first, last):
+    """
+    :param int first: First bus in minutes after midnight, or None
+    :param int last: Last bus in minutes after midnight, or None
+    :return: (first, last) with a last bus after midnight moved past 1440, or None if the bus does not run that day.
+    A single trip, whose first bus is also its last bus, is never running between them.
+    """
+    if first is None or last is None:
+        return None
+    if last < first:
+        last += 24 * 60
+    return first, last
+
+
+class RouteTimings:
+    """
+    First and last bus timings of a bus service at a bus stop, in minutes after midnight
+    """
+    __slots__ = ('wd_first', 'wd_last', 'sat_first', 'sat_last', 'sun_first', 'sun_last', 'windows')
+
+    def __init__(self, wd_first, wd_last, sat_first, sat_last, sun_first, sun_last):
+        self.wd_first = wd_first
+        self.wd_last = wd_last
+        self.sat_first = sat_first
+        self.sat_last = sat_last
+        self.sun_first = sun_first
+        self.sun_last = sun_last
+        # (first, last) for weekdays, Saturdays and Sundays/public holidays, indexed by service_calendar's day types
+        self.windows = (service_window(wd_first, wd_last), service_window(sat_first, sat_last),
+                        service_window(sun_first, sun_last))
+
+
+class RouteIndex:
+    """
+    Bus routes keyed by (bus number, bus stop code) and by bus number
+    """
+    def __init__(self, timings, routes):
+        self._timings = timings
+        self._routes = routes
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        :param rows: Iterable of bus_routes.txt rows in the form returned by read_bus_routes
+        :return: RouteIndex
+        """
+        timings, routes = dict(), dict()
+        for row in rows:
+            bus_num, direction, bus_stop_code, bus_stop_name = row[:4]
+            # A loop service passes some bus stops twice. Keep the first visit like the old linear scan did.
+            if (bus_num, bus_stop_code) not in timings:
+                timings[(bus_num, bus_stop_code)] = RouteTimings(*row[4:10])
+            routes.setdefault(bus_num, dict()).setdefault(direction, list()).append((bus_stop_code, bus_stop_name))
+        return cls(timings, routes)
+
+    @classmethod
+    def from_file(cls, path=BUS_ROUTES_FILE):
+        """
+        :param str path: Path of bus_routes.txt
+        :return: RouteIndex
+        """
+        return cls.from_rows(read_bus_routes(path))
+
+    def timings(self, bus_num, bus_stop_code):
+        """
+        :param str bus_num: Bus Number
+        :param str bus_stop_code: Bus Stop Code of bus stop
+        :return: RouteTimings or None if the bus does not stop there
+        """
+        return self._timings.get((bus_num, bus_stop_code))
+
+    def route(self, bus_num):
+        """
+        :param str bus_num: Bus Number
+        :return: Dict of direction ('1'/'2') to the list of (bus stop code, bus stop name) in travelling order
+        """
+        return self._routes.get(bus_num, dict())
+
+    def __contains__(self, bus_num):
+        return bus_num in self._routes
+
+
+# Both indexes are replaced together in one assignment
+_bus_index = None
+
+
+def load_bus_index():
+    """
+    Build the indexes from the text files and swap them in. Readers holding the previous indexes keep using them
+    until they ask again, so a refresh never exposes a half-built index.
+    """
+    global _bus_index
+    _bus_index = (BusStopRegistry.from_file(), RouteIndex.from_file())
+
+
+def bus_stop_registry():
+    """
+    :return: The current BusStopRegistry, loading it on first use
+    """
+    if _bus_index is None:
+        load_bus_index()
+    return _bus_index[0]
+
+
+def route_index():
+    """
+    :return: The current RouteIndex, loading it on first use
+    """
+    if _bus_index is None:
+        load_bus_index()
+    return _bus_index[1]
@@ -0,0 +1,107 @@
+"""
+Which reply the bot is waiting for from each user
+"""
+import threading
+from collections import OrderedDict
+
+# Pending replies, in the order that user_input handles them when a user has more than one
+RENAMING_BUS_STOP = 1
+FEEDBACK = 2
+SCHEDULE_BUS_STOP = 3
+SCHEDULE_BUSES = 4
+SCHEDULE_TIME = 5
+
+# One round trip, served by the partial indexes on pending rows, for every pending reply of a user: rename (users
+# state 1), feedback (feedback state 1) and the three steps of scheduling a message (schedules state 1, 2 and 3)
+PENDING_STATES_QUERY = """
+    SELECT 1 FROM users WHERE user_id=%(user_id)s AND state=1
+    UNION
+    SELECT 2 FROM feedback WHERE user_id=%(user_id)s AND state=1
+    UNION
+    SELECT 2 + state FROM schedules WHERE user_id=%(user_id)s AND state IN (1, 2, 3)
+"""
+
+
+class ConversationStates:
+    """
+    Write-through cache of every user's pending replies. A user's states are read from the database once with
+    PENDING_STATES_QUERY; afterwards the handlers that change a state in the database update the cache as well, so
+    ordinary messages from users that the bot is not waiting on need no query at all.
+    """
+    def __init__(self, db, max_size=10000):
+        """
+        :param database.Database db: Database with the users, feedback and schedules tables
+        :param int max_size: Maximum number of users kept before the least recently used is evicted
+        """
+        self._db = db
+        self.max_size = max_size
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every change so that a query that raced with a change is not cached
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """
+        :param user_id: Chat id of the user
+        :return: The pending reply that comes first, or None if the bot is not waiting on the user
+        """
+        states = self.pending(user_id)
+        return min(states) if states else None
+
+    def pending(self, user_id):
+        """
+        :param user_id: Chat id of the user
+        :return: frozenset of every pending reply of the user
+        """
+        with self._lock:
+            states = self._states.get(user_id)
+            if states is not None:
+                self._states.move_to_end(user_id)
+                self.hits += 1
+                return states
+            self.misses += 1
+            version = self._version
+
+        states = frozenset(row[0] for row in self._db.fetchall(PENDING_STATES_QUERY, {'user_id': user_id}))
+        with self._lock:
+            if version == self._version:
+                self._states[user_id] = states
+                while len(self._states) > self.max_size:
+                    self._states.popitem(last=False)
+        return states
+
+    def add(self, user_id, state):
+        """
+        Record that the bot is now waiting on the user for a reply. Call after writing the state to the database.
+        :param user_id: Chat id of the user
+        :param int state: One of the states above
+        """
+        self._update(user_id, lambda states: states | {state})
+
+    def discard(self, user_id, state):
+        """
+        Record that the bot is no longer waiting on the user for a reply. Call after writing to the database.
+        :param user_id: Chat id of the user
+        :param int state: One of the states above
+        """
+        self._update(user_id, lambda states: states - {state})
+
+    def invalidate(self, user_id):
+        """
+        Forget the user's states so that they are read from the database again, for changes whose outcome is not
+        known without a query
+        :param user_id: Chat id of the user
+        """
+        with self._lock:
+            self._version += 1
+            self._states.pop(user_id, None)
+
+    def _update(self, user_id, change):
+        with self._lock:
+            self._version += 1
+            states = self._states.get(user_id)
+            # Users that are not cached are read from the database on their next message
+            if states is not None:
+                self._states[user_id] = frozenset(change(states))
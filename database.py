@@ -0,0 +1,194 @@
+"""
+Thread-safe access to the Postgres database through a connection pool
+"""
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from time import perf_counter, monotonic
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Connections idle for longer than this are checked with a round trip before they are handed out, since Heroku drops
+# idle SSL connections without the client noticing
+IDLE_CHECK_SECONDS = 30
+
+
+def is_disconnect(error, conn):
+    """
+    :param Exception error: Error raised by a statement
+    :param conn: Connection the statement ran on
+    :return: True if the connection was lost, as opposed to e.g. a statement timeout or a deadlock on a healthy one
+    """
+    return isinstance(error, psycopg2.InterfaceError) or (isinstance(error, psycopg2.OperationalError) and
+                                                          bool(conn.closed))
+
+
+def is_read(query):
+    """
+    :param str query: SQL statement
+    :return: True if the statement only reads, so it can be run again after its connection was lost
+    """
+    return query.lstrip()[:6].upper() == 'SELECT'
+
+
+class Database:
+    """
+    Every call checks a connection out of a ThreadedConnectionPool and uses its own cursor, so handlers on the
+    dispatcher's worker threads and jobs never share a cursor. Callers wait for a free connection when all of them
+    are in use. A connection that has been idle for a while is checked before it is handed out and replaced if the
+    server dropped it. A SELECT whose connection is lost while it runs is run once more on another connection; any
+    other statement is not, since the server may already have committed it.
+    """
+    def __init__(self, dsn, minconn=1, maxconn=8, **connect_kwargs):
+        """
+        :param str dsn: libpq connection string or URL
+        :param int minconn: Connections opened at startup
+        :param int maxconn: Maximum number of open connections
+        :param connect_kwargs: Extra arguments for psycopg2.connect, e.g. sslmode
+        """
+        self._pool = ThreadedConnectionPool(minconn, maxconn, dsn, **connect_kwargs)
+        self._maxconn = maxconn
+        # ThreadedConnectionPool raises instead of blocking when it is exhausted
+        self._available = threading.BoundedSemaphore(maxconn)
+        # id of each pooled connection -> time.monotonic() it was returned to the pool
+        self._idle_since = dict()
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection with autocommit on and return it to the pool afterwards.
+        Connections that were closed by the server are discarded instead of being returned.
+        """
+        start = perf_counter()
+        self._available.acquire()
+        metrics.db_pool_wait_seconds.observe(None, perf_counter() - start)
+
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._available.release()
+            raise
+        try:
+            yield conn
+        finally:
+            if not conn.closed:
+                self._idle_since[id(conn)] = monotonic()
+            else:
+                self._idle_since.pop(id(conn), None)
+            self._pool.putconn(conn, close=bool(conn.closed))
+            self._available.release()
+
+    def _checkout(self):
+        # Every pooled connection may have been dropped, the last attempt opens a new one
+        for attempt in range(self._maxconn + 1):
+            conn = self._pool.getconn()
+            idle_since = self._idle_since.get(id(conn))
+            try:
+                conn.autocommit = True
+                # Connections opened by the pool have not been handed out yet, so they are checked once too
+                if idle_since is None or monotonic() - idle_since > IDLE_CHECK_SECONDS:
+                    with conn.cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                return conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if not is_disconnect(e, conn) or attempt == self._maxconn:
+                    self._pool.putconn(conn, close=bool(conn.closed))
+                    raise
+                logger.warning('Database connection lost, reconnecting: %s', e)
+                self._idle_since.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                metrics.db_reconnects.inc('checkout')
+
+    def _run(self, operation, query, params, fetch):
+        # Time spent waiting for a connection is in bot_db_pool_wait_seconds instead
+        seconds = 0.0
+        attempts = 2 if is_read(query) else 1
+        try:
+            for attempt in range(attempts):
+                with self.connection() as conn:
+                    start = perf_counter()
+                    try:
+                        with conn.cursor() as cursor:
+                            cursor.execute(query, params)
+                            return fetch(cursor)
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                        if not is_disconnect(e, conn) or attempt == attempts - 1:
+                            raise
+                        logger.warning('Database connection lost, running the query again: %s', e)
+                        metrics.db_reconnects.inc('query')
+                    finally:
+                        seconds += perf_counter() - start
+        except Exception:
+            metrics.db_errors.inc(operation)
+            raise
+        finally:
+            metrics.db_seconds.observe(operation, seconds)
+
+    def execute(self, query, params=None):
+        """
+        Run a statement
+        :param str query: SQL with %s placeholders
+        :param params: Query parameters
+        """
+        self._run('execute', query, params, lambda cursor: None)
+
+    def fetchone(self, query, params=None):
+        """
+        Run a query and return its first row
+        :param str query: SQL with %s placeholders
+        :param params: Query parameters
+        :return: Tuple or None if there are no rows
+        """
+        return self._run('fetchone', query, params, lambda cursor: cursor.fetchone())
+
+    def fetchall(self, query, params=None):
+        """
+        Run a query and return all of its rows
+        :param str query: SQL with %s placeholders
+        :param params: Query parameters
+        :return: List of tuples
+        """
+        return self._run('fetchall', query, params, lambda cursor: cursor.fetchall())
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run several statements atomically on one connection
+        :return: Cursor that commits when the block exits and rolls back if it raises
+        """
+        start = None
+        try:
+            with self.connection() as conn:
+                start = perf_counter()
+                conn.autocommit = False
+                try:
+                    with conn:
+                        with conn.cursor() as cursor:
+                            yield cursor
+                finally:
+                    if not conn.closed:
+                        conn.autocommit = True
+        except Exception:
+            metrics.db_errors.inc('transaction')
+            raise
+        finally:
+            if start is not None:
+                metrics.db_seconds.observe('transaction', perf_counter() - start)
+
+
+def connect():
+    """
+    :return: Database for DATABASE_URL on Heroku, or the local database
+    """
+    maxconn = int(os.environ.get('DATABASE_POOL_SIZE', '8'))
+    # If using database from Heroku
+    if os.environ.get('DATABASE_URL'):
+        return Database(os.environ.get('DATABASE_URL'), maxconn=maxconn, sslmode='require')
+    # If using local database
+    return Database("dbname=telegram_bot user=postgres password=admin", maxconn=maxconn)
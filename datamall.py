@@ -0,0 +1,121 @@
+"""
+Shared client for the LTA DataMall API with connection pooling, timeouts, retries and latency metrics
+"""
+import os
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+BASE_URL = 'http://datamall2.mytransport.sg/ltaodataservice/'
+
+# (connect, read) timeouts in seconds for each endpoint
+TIMEOUTS = {
+    'BusArrivalv2': (3.05, 5),
+    'TrainServiceAlerts': (3.05, 10),
+    'BusStops': (3.05, 30),
+    'BusRoutes': (3.05, 30),
+}
+DEFAULT_TIMEOUT = (3.05, 10)
+
+# DataMall returns at most 500 records per call
+PAGE_SIZE = 500
+
+# Status codes worth trying again: rate limited or a temporary server error
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class DataMallError(Exception):
+    """
+    DataMall returned an error status after all retries
+    """
+
+
+class DataMallClient:
+    """
+    Keeps connections to DataMall alive between calls. Every call has a timeout and is retried a bounded number of
+    times with exponential backoff and jitter on connection errors, timeouts and RETRY_STATUS responses.
+    """
+    def __init__(self, account_key, pool_size=16, max_retries=2, backoff=0.25):
+        """
+        :param str account_key: LTA DataMall account key
+        :param int pool_size: Maximum number of kept-alive connections
+        :param int max_retries: Number of retries after the first attempt
+        :param float backoff: Base delay in seconds before the first retry, doubled for each retry after
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._session = requests.Session()
+        self._session.headers['AccountKey'] = account_key or ''
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def get(self, endpoint, params=None):
+        """
+        Call a DataMall endpoint
+        :param str endpoint: Endpoint name, e.g. 'BusArrivalv2'
+        :param dict params: Query parameters
+        :return: Decoded JSON response
+        """
+        timeout = TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        for attempt in range(self.max_retries + 1):
+            start = perf_counter()
+            try:
+                response = self._session.get(BASE_URL + endpoint, params=params, timeout=timeout)
+                if response.status_code in RETRY_STATUS:
+                    raise DataMallError('{} returned {}'.format(endpoint, response.status_code))
+                response.raise_for_status()
+                data = response.json()
+            except (requests.ConnectionError, requests.Timeout, DataMallError):
+                self._record(endpoint, perf_counter() - start, error=True, retry=attempt < self.max_retries)
+                if attempt == self.max_retries:
+                    raise
+                # Full jitter so that retries from many threads do not arrive together
+                sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            except Exception:
+                self._record(endpoint, perf_counter() - start, error=True)
+                raise
+            else:
+                self._record(endpoint, perf_counter() - start)
+                return data
+
+    def get_all(self, endpoint, workers=8):
+        """
+        Get every record of a paginated endpoint, requesting up to `workers` pages at once. The first page shorter
+        than PAGE_SIZE marks the end of the data; pages requested beyond it are discarded.
+        :param str endpoint: Endpoint name, e.g. 'BusRoutes'
+        :param int workers: Maximum number of pages requested concurrently
+        :return: List of all the records, in the same order as fetching the pages one by one
+        """
+        records = list()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=endpoint) as executor:
+            pages = deque(executor.submit(self.get, endpoint, {'$skip': page * PAGE_SIZE}) for page in range(workers))
+            next_page = workers
+            try:
+                while pages:
+                    page = pages.popleft().result()['value']
+                    records.extend(page)
+                    if len(page) < PAGE_SIZE:
+                        break
+                    pages.append(executor.submit(self.get, endpoint, {'$skip': next_page * PAGE_SIZE}))
+                    next_page += 1
+            finally:
+                for page in pages:
+                    page.cancel()
+        return records
+
+    def _record(self, endpoint, seconds, error=False, retry=False):
+        metrics.datamall_seconds.observe(endpoint, seconds)
+        if error:
+            metrics.datamall_errors.inc(endpoint)
+        if retry:
+            metrics.datamall_retries.inc(endpoint)
+
+
+datamall = DataMallClient(os.environ.get('LTA_TOKEN_KEY'))
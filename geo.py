@@ -0,0 +1,145 @@
+"""
+Distance calculations and spatial lookups over bus stop coordinates
+"""
+from math import cos, sin, asin, sqrt, radians, floor, ceil
+import numpy as np
+
+# Radius of earth in kilometers. Use 3956 for miles
+EARTH_RADIUS = 6371
+# About 280m per grid cell, so a 350m search around a user only looks at a handful of cells
+GRID_CELL_DEGREES = 0.0025
+
+
+def haversine(current_lat, current_lon, bus_stop_lat, bus_stop_lon):
+    """
+    Haversine Formula: Calculate the  circle distance between two points on Earth
+    :param str current_lat: Latitude of user's location
+    :param str current_lon: Longitude of user;s location
+    :param float bus_stop_lat: Latitude of bus stop
+    :param float bus_stop_lon: Longitude of bus stop
+    :return: Distance between user's current location and bus stop
+    """
+
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(radians, [current_lon, current_lat, bus_stop_lon, bus_stop_lat])
+
+    diff_lon = lon2 - lon1
+    diff_lat = lat2 - lat1
+    a = sin(diff_lat/2)**2 + cos(lat1) * cos(lat2) * sin(diff_lon/2)**2
+    c = 2 * asin(sqrt(a))
+
+    return c * EARTH_RADIUS
+
+
+def haversine_many(latitudes, longitudes, stop_latitudes, stop_longitudes):
+    """
+    Vectorised haversine formula from one or many points to many bus stops in a single array operation
+    :param latitudes: Latitude of user's location in degrees, a float or a 1-d array of latitudes
+    :param longitudes: Longitude of user's location in degrees, a float or a 1-d array of longitudes
+    :param numpy.ndarray stop_latitudes: Latitudes of bus stops in radians
+    :param numpy.ndarray stop_longitudes: Longitudes of bus stops in radians
+    :return: Distances in kilometers, with shape (stops,) for one point or (points, stops) for many points
+    """
+    lat1 = np.radians(np.asarray(latitudes, dtype=np.float64))[..., np.newaxis]
+    lon1 = np.radians(np.asarray(longitudes, dtype=np.float64))[..., np.newaxis]
+    if lat1.ndim == 1:
+        lat1, lon1 = lat1[0], lon1[0]
+
+    a = np.sin((stop_latitudes - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(stop_latitudes) * np.sin((stop_longitudes - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class SpatialGrid:
+    """
+    Uniform latitude/longitude grid over coordinate arrays.
+    Queries only measure distances to the points in the cells around the query point.
+    """
+    def __init__(self, latitudes, longitudes, cell_size=GRID_CELL_DEGREES):
+        """
+        :param numpy.ndarray latitudes: Contiguous float64 latitudes in radians
+        :param numpy.ndarray longitudes: Contiguous float64 longitudes in radians
+        :param float cell_size: Size of a grid cell in degrees
+        """
+        self._latitudes = latitudes
+        self._longitudes = longitudes
+        self._cell_size = radians(cell_size)
+
+        cells = dict()
+        rows = np.floor(latitudes / self._cell_size).astype(np.int64).tolist()
+        columns = np.floor(longitudes / self._cell_size).astype(np.int64).tolist()
+        for index, cell in enumerate(zip(rows, columns)):
+            cells.setdefault(cell, list()).append(index)
+        self._cells = {cell: np.array(indices, dtype=np.int64) for cell, indices in cells.items()}
+
+        if self._cells:
+            self._bounds = (min(rows), max(rows), min(columns), max(columns))
+
+    def _cell(self, latitude, longitude):
+        return floor(radians(latitude) / self._cell_size), floor(radians(longitude) / self._cell_size)
+
+    def _cell_width(self, latitude):
+        """
+        :return: Height and width of a grid cell around this latitude in kilometers
+        """
+        height = self._cell_size * EARTH_RADIUS
+        return height, height * max(cos(radians(latitude)), 1e-6)
+
+    def _indices_in(self, rows, columns):
+        indices = [self._cells[(row, column)] for row in rows for column in columns if (row, column) in self._cells]
+        return np.concatenate(indices) if indices else np.empty(0, dtype=np.int64)
+
+    def _sorted(self, latitude, longitude, indices):
+        distances = haversine_many(latitude, longitude, self._latitudes[indices], self._longitudes[indices])
+        order = np.argsort(distances, kind='stable')
+        return distances[order], indices[order]
+
+    def within(self, latitude, longitude, radius):
+        """
+        Find every point within a radius of a location
+        :param float latitude: Latitude of user's location in degrees
+        :param float longitude: Longitude of user's location in degrees
+        :param float radius: Search radius in kilometers
+        :return: Arrays of (distances, indices) sorted from nearest to furthest
+        """
+        height, width = self._cell_width(latitude)
+        row, column = self._cell(latitude, longitude)
+        row_span, column_span = ceil(radius / height), ceil(radius / width)
+
+        indices = self._indices_in(range(row - row_span, row + row_span + 1),
+                                   range(column - column_span, column + column_span + 1))
+        distances, indices = self._sorted(latitude, longitude, indices)
+        inside = np.searchsorted(distances, radius, side='right')
+        return distances[:inside], indices[:inside]
+
+    def nearest(self, latitude, longitude, k):
+        """
+        Find the k nearest points to a location by searching rings of cells outwards
+        :param float latitude: Latitude of user's location in degrees
+        :param float longitude: Longitude of user's location in degrees
+        :param int k: Number of points to return
+        :return: Arrays of at most k (distances, indices) sorted from nearest to furthest
+        """
+        if not self._cells or k <= 0:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+
+        row, column = self._cell(latitude, longitude)
+        min_row, max_row, min_column, max_column = self._bounds
+        last_ring = max(abs(row - min_row), abs(row - max_row), abs(column - min_column), abs(column - max_column))
+        # Everything outside ring n is at least n cells away from the query point
+        cell_km = min(self._cell_width(latitude))
+
+        found = list()
+        for ring in range(last_ring + 1):
+            if ring == 0:
+                found.append(self._indices_in((row,), (column,)))
+            else:
+                found.append(self._indices_in((row - ring, row + ring), range(column - ring, column + ring + 1)))
+                found.append(self._indices_in(range(row - ring + 1, row + ring), (column - ring, column + ring)))
+
+            if sum(len(indices) for indices in found) >= k:
+                distances, indices = self._sorted(latitude, longitude, np.concatenate(found))
+                if distances[k - 1] <= ring * cell_km:
+                    return distances[:k], indices[:k]
+        distances, indices = self._sorted(latitude, longitude, np.concatenate(found))
+        return distances[:k], indices[:k]
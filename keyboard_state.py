@@ -0,0 +1,137 @@
+"""
+Bus numbers a user has picked on the scheduling keyboard, kept on the server so that each button only carries a token
+"""
+import secrets
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Most buses a scheduled message shows, the oldest pick is dropped for a new one
+MAX_SELECTED = 5
+# Buttons per row of the keyboard
+COLUMNS = 3
+
+
+def bus_selection_keyboard(token, bus_services):
+    """
+    Grid of bus numbers, COLUMNS per row, with the Confirm button after the last bus number
+    :param str token: Token of the selection
+    :param list bus_services: Bus numbers at the bus stop
+    :return: InlineKeyboardMarkup whose buttons send 'bus_<token>_<index>' and 'confirm_bus_num_<token>', well under
+    Telegram's 64 bytes of callback_data however many buses stop there
+    """
+    buttons = [InlineKeyboardButton(bus_service, callback_data='bus_{}_{}'.format(token, index))
+               for index, bus_service in enumerate(bus_services)]
+    buttons.append(InlineKeyboardButton('Confirm', callback_data='confirm_bus_num_{}'.format(token)))
+    return InlineKeyboardMarkup([buttons[i:i + COLUMNS] for i in range(0, len(buttons), COLUMNS)])
+
+
+class BusSelection:
+    """
+    Bus numbers offered at a bus stop and the ones picked so far, in the order they were picked
+    """
+    __slots__ = ('bus_stop_code', 'bus_services', 'selected', 'reply_markup', 'expires')
+
+    def __init__(self, bus_stop_code, bus_services, reply_markup, expires):
+        self.bus_stop_code = bus_stop_code
+        self.bus_services = bus_services
+        self.selected = list()
+        self.reply_markup = reply_markup
+        self.expires = expires
+
+    def toggle(self, index):
+        """
+        Pick the bus number at the index, or unpick it if it was picked already
+        :param int index: Index into bus_services
+        :return: False if there is no bus number at the index
+        """
+        if not 0 <= index < len(self.bus_services):
+            return False
+        bus_service = self.bus_services[index]
+        if bus_service in self.selected:
+            self.selected.remove(bus_service)
+        else:
+            self.selected.append(bus_service)
+            del self.selected[:-MAX_SELECTED]
+        return True
+
+    def selected_text(self):
+        """
+        :return: The picked bus numbers joined with commas, or 'None'
+        """
+        return ','.join(self.selected) or 'None'
+
+
+class KeyboardStates:
+    """
+    Selections by token, evicting the least recently used when full and dropping those older than the time to live.
+    A selection that is gone, e.g. after a restart, makes its keyboard stale and the user schedules again.
+    """
+    def __init__(self, max_size=10000, ttl=3600):
+        """
+        :param int max_size: Maximum number of selections kept
+        :param float ttl: Seconds after the last tap before a selection expires
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._selections = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, bus_stop_code, bus_services):
+        """
+        :param str bus_stop_code: Bus Stop Code of bus stop
+        :param list bus_services: Bus numbers at the bus stop
+        :return: BusSelection with its keyboard built
+        """
+        with self._lock:
+            token = secrets.token_hex(4)
+            while token in self._selections:
+                token = secrets.token_hex(4)
+            selection = BusSelection(bus_stop_code, tuple(bus_services), bus_selection_keyboard(token, bus_services),
+                                     monotonic() + self.ttl)
+            self._selections[token] = selection
+            while len(self._selections) > self.max_size:
+                self._selections.popitem(last=False)
+        return selection
+
+    def get(self, token):
+        """
+        :param str token: Token from the callback data
+        :return: BusSelection, or None if it expired or never existed
+        """
+        now = monotonic()
+        with self._lock:
+            selection = self._selections.get(token)
+            if selection is None:
+                return None
+            if selection.expires < now:
+                del self._selections[token]
+                return None
+            selection.expires = now + self.ttl
+            self._selections.move_to_end(token)
+            return selection
+
+    def toggle(self, token, index):
+        """
+        :param str token: Token from the callback data
+        :param int index: Index of the bus number that was tapped
+        :return: BusSelection after the tap, or None if it expired or never existed
+        """
+        selection = self.get(token)
+        if selection is None:
+            return None
+        with self._lock:
+            selection.toggle(index)
+        return selection
+
+    def discard(self, token):
+        """
+        :param str token: Token of a selection that was confirmed
+        """
+        with self._lock:
+            self._selections.pop(token, None)
+
+    def __len__(self):
+        return len(self._selections)
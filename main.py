@@ -2,35 +2,65 @@ from telegram import *
 from telegram.ext import *
 
 import logging
-import psycopg2
+import database
 import pytz
-from datetime import time
-from difflib import SequenceMatcher
+from datetime import time, timezone
+from time import monotonic
 
 from shortcuts import *
 from bus_data import *
 from telegram_messages import *
+from broadcast import broadcaster
+from schedule_wheel import ScheduleWheel
+from conversation_state import *
+from migrations import migrate
+from write_behind import WriteBehind
+from mrt_alerts import MrtAlertPoller
+from media_cache import MediaCache
+from keyboard_state import KeyboardStates
+import metrics
 
 # Tokens for telegram and LTA API
 TOKEN = os.environ.get('TELEGRAM_TOKEN_KEY')
 LTA_TOKEN_KEY = os.environ.get('LTA_TOKEN_KEY')
 
 PORT = int(os.environ.get('PORT', '5000'))
+# Threads running the handlers, python-telegram-bot's default
+DISPATCHER_WORKERS = 4
+# Local port of the Prometheus metrics next to the webhook
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9100'))
+
+# Set LOCATION_SEARCH_MODE=compat to use the original unranked location search
+LOCATION_SEARCH_COMPAT = os.environ.get('LOCATION_SEARCH_MODE') == 'compat'
 
 # TODO: feedback photos
 # TODO: schedule msg new format
 
-# If using database from Heroku
-if os.environ.get('DATABASE_URL'):
-    postgres_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(postgres_url, sslmode='require')
-# If using local database
-else:
-    conn = psycopg2.connect("dbname=telegram_bot "
-                            "user=postgres "
-                            "password=admin")
-conn.autocommit = True
-db = conn.cursor()
+# Pool of connections shared by the handlers and jobs, each call uses its own connection and cursor
+db = database.connect()
+
+# Scheduled messages by minute of the day, so send_scheduled_msg does not query the database every minute
+schedule_wheel = ScheduleWheel()
+
+# Reply that the bot is waiting for from each user, so most messages do not query the database for it
+conversation_states = ConversationStates(db)
+
+# Bus numbers picked on each scheduling keyboard, the buttons carry a token instead of the bus numbers
+keyboard_states = KeyboardStates()
+
+# Sends each new MRT alert once to the users who opted in, picking up where it stopped after a restart
+mrt_alert_poller = MrtAlertPoller(db, broadcaster, fetch_mrt_alerts, mrt_alerts_message, TRAINS_NORMAL_MSG)
+
+# Static images are uploaded once and sent again by file_id
+media_cache = MediaCache(db)
+
+# Upserts that handlers do not wait on, written in batches in the background
+write_behind = WriteBehind(db)
+# all_users was created by hand, only its first and last columns are known by name
+write_behind.register('all_users', "INSERT INTO all_users VALUES %s ON CONFLICT DO NOTHING", key=lambda row: row[0])
+write_behind.register('bus_stop_code_history', 'INSERT INTO bus_stop_code_history (user_id, bus_stop_code, '
+                                               'description, datetime) VALUES %s ON CONFLICT (user_id, bus_stop_code) '
+                                               'DO UPDATE SET datetime=EXCLUDED.datetime', key=lambda row: row[:2])
 
 # Enable logging
 logging.basicConfig(
@@ -51,8 +81,7 @@ def start(update: Update, context: CallbackContext):
     location_keyboard = KeyboardButton(text="Send Location 📍", request_location=True)
     reply_markup = ReplyKeyboardMarkup([[location_keyboard]], resize_keyboard=True, one_time_keyboard=True)
     update.message.reply_text(welcome_msg(), reply_markup=reply_markup)
-    db.execute("INSERT INTO all_users VALUES (%s, %s, 'Yes') ON CONFLICT DO NOTHING",
-               (update.message.chat_id, update.message.from_user.full_name))
+    write_behind.put('all_users', (update.message.chat_id, update.message.from_user.full_name, 'Yes'))
 
 
 def nearest_locations(update: Update, context: CallbackContext):
@@ -64,23 +93,14 @@ def nearest_locations(update: Update, context: CallbackContext):
     if user_message is None:
         location = update.effective_message.location
         location = (location.latitude, location.longitude)
-        nearest_bus_stops = list()
         send_message = "<b>Nearest Bus Stops:</b> \n\n" \
                        "Click on any of the bus stop codes\n" \
                        "below to get the bus arrival timings\n" \
                        "for that bus stop!\n\n"
-        with open('bus_stops.txt', 'r') as r:
-            for bus_stop in r.readlines():
-                bus_stop_location = bus_stop.split(' | ', 5)
-                distance = haversine(location[0], location[1], float(bus_stop_location[3]), float(bus_stop_location[4]))
-                if distance <= 0.35:
-                    bus_stop_location.append(str(distance))
-                    nearest_bus_stops.append(bus_stop_location)
-
-        nearest_bus_stops.sort(key=lambda x: x[-1])
-        for nearest_bus_stop in nearest_bus_stops:
-            send_message += "<b>{}</b>\n{} (/{})\n\n".format(nearest_bus_stop[2], nearest_bus_stop[1],
-                                                             nearest_bus_stop[0])
+        nearest_bus_stops = bus_stop_registry().within(location[0], location[1], 0.35)
+        for distance, nearest_bus_stop in nearest_bus_stops:
+            send_message += "<b>{}</b>\n{} (/{})\n\n".format(nearest_bus_stop.description,
+                                                             nearest_bus_stop.road_name, nearest_bus_stop.code)
 
         update.message.reply_text(send_message, parse_mode=ParseMode.HTML)
 
@@ -93,260 +113,210 @@ def nearest_locations(update: Update, context: CallbackContext):
 
 def user_input(update: Update, context: CallbackContext):
     """
-    Execute different functions according to what user has typed and the current state of feedback & schedules table
+    Execute different functions according to what user has typed and the reply that the bot is waiting for, if any
     """
-    # state=1 means that bot is expecting a new name from user when users rename their bus stop
-    db.execute("SELECT * FROM users WHERE user_id=%s AND state='1'", (update.message.chat_id,))
-    renaming_bus_stop = db.fetchone()
-    if renaming_bus_stop:
-        if update.message.text == '/exit':
-            db.execute("UPDATE users SET state='0' WHERE user_id=%s AND state='1'", (update.message.chat_id,))
-            update.message.reply_text('Quit Renaming Bus Stop...')
-        else:
-            new_name = update.message.text.upper()
-            update.message.reply_text("<b>Successful!</b>\nOriginal: <b>{}</b>\nNew: <b>{}</b>"
-                                      .format(renaming_bus_stop[2], new_name), parse_mode=ParseMode.HTML)
-            db.execute("UPDATE users SET new_description=%s, state='0' WHERE user_id=%s AND description=%s",
-                       (new_name, update.message.chat_id, renaming_bus_stop[2]))
+    state = conversation_states.get(update.message.chat_id)
+    if state == RENAMING_BUS_STOP:
+        rename_bus_stop_input(update, context)
         return
 
     message = update.message.text.replace('/', '').lower()
     bot_typing(context.bot, update.message.chat_id)
+    STATE_HANDLERS.get(state, bus_query_input)(update, context, message)
 
-    # state=1 means that bot is expecting a feedback from user
-    db.execute("SELECT * FROM feedback WHERE user_id=%s AND state='1'", (update.message.chat_id,))
-    user_feedback = db.fetchone()
-
-    # state=1 means that bot is expecting a bus stop code from user to schedule a message
-    db.execute("SELECT * FROM schedules WHERE user_id=%s AND state='1'", (update.message.chat_id,))
-    schedule_bus_code = db.fetchone()
-
-    # state=2 means that bot is expecting bus numbers from user to schedule a message
-    db.execute("SELECT * FROM schedules WHERE user_id=%s AND state='2'", (update.message.chat_id,))
-    schedule_buses = db.fetchone()
-
-    # state=3 means that bot is expecting a time from user to schedule a message
-    db.execute("SELECT * FROM schedules WHERE user_id=%s AND state='3'", (update.message.chat_id,))
-    schedule_msg_time = db.fetchone()
-
-    # Deal with user's feedback
-    if user_feedback:
-        # Ensure that user message is kind of appropriate. To be improved...
-        if len(message) > 5:
-            db.execute("UPDATE feedback SET user_feedback=%s, datetime=%s, state='0' WHERE user_id=%s AND state='1'",
-                       (message, str(datetime.utcnow() + timedelta(hours=8)).split('.')[0],
-                        update.message.chat_id))
-            update.message.reply_text('Thank you for your feedback!')
-        elif 'exit' in message:
-            db.execute("DELETE FROM feedback WHERE user_id=%s AND state='1'", (update.message.chat_id,))
-            update.message.reply_text('Quit Feedback Section...')
-        else:
-            update.message.reply_text('Please type in a feedback that is appropriate/longer.\n\n'
-                                      'Click/Type /exit to stop giving feedback.')
-
-    # Deals with bus stop code when user is scheduling message
-    # Change state=2 for schedules table. Expecting user for a time to schedule the message next.
-    elif schedule_bus_code:
-        if (len(message) == 5) and message.isdigit():
-            description = None
-            with open('bus_stops.txt', 'r') as r:
-                for bus_stop in r.readlines():
-                    if bus_stop.split(' | ')[0] == message:
-                        description = bus_stop.split(' | ', 3)[2]
-                        break
-
-            url = "http://datamall2.mytransport.sg/ltaodataservice/BusArrivalv2?BusStopCode={}".format(message)
-            headers = {'AccountKey': LTA_TOKEN_KEY}
-            response = requests.get(url, headers=headers).json()
-            all_buses = response['Services']
-            all_bus_services = list()
-            # To get all the bus service number into a list
-            for bus in all_buses:
-                all_bus_services.append(bus['ServiceNo'])
-
-            # bus_services_data is a string consisting of bus numbers separated by commas
-            bus_services_data = ','.join(all_bus_services)
-            if description:
-                db.execute("SELECT * FROM schedules WHERE user_id=%s AND state='2'", (update.message.chat_id,))
-                user = db.fetchall()
-                # To delete any duplicates
-                if user:
-                    db.execute("DELETE FROM schedules WHERE user_id=%s AND state='2'", (update.message.chat_id,))
-
-                bot_typing(context.bot, update.message.chat_id)
-
-                # Keyboard display for all the bus numbers of a bus stop
-                # Maximum number of columns per row is 3
-                keyboard, sublist = list(), list()
-                for bus_service in all_bus_services:
-                    if len(sublist) < 3:
-                        sublist.append(InlineKeyboardButton(bus_service, callback_data='bus_{}_{}'
-                                                            .format(bus_service, bus_services_data)))
-                    if len(sublist) == 3:
-                        keyboard.append(sublist)
-                        sublist = list()
-
-                # Find the remainder number of bus number in the last row
-                num_remaining = len(all_bus_services) % 3
-                # Last row will consist of 2 bus numbers and a confirm button
-                if num_remaining == 2:
-                    keyboard.append([InlineKeyboardButton(all_bus_services[-2], callback_data='bus_{}_{}'.
-                                                          format(all_bus_services[-2], bus_services_data)),
-                                     InlineKeyboardButton(all_bus_services[-1], callback_data='bus_{}_{}'.
-                                                          format(all_bus_services[-1], bus_services_data)),
-                                     InlineKeyboardButton('Confirm', callback_data='confirm_bus_num')])
-                # Last row will consist of 1 bus number and a confirm button
-                elif num_remaining == 1:
-                    keyboard.append([InlineKeyboardButton(all_bus_services[-1], callback_data='bus_{}_{}'.
-                                                          format(all_bus_services[-1], bus_services_data)),
-                                     InlineKeyboardButton('Confirm', callback_data='confirm_bus_num')])
-                # Last row will consist of no bus number but only a confirm button
-                else:
-                    keyboard.append([InlineKeyboardButton('Confirm', callback_data='confirm_bus_num')])
-
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                update.message.reply_text(schedule_bus_number(message, 'None'), reply_markup=reply_markup,
-                                          parse_mode=ParseMode.HTML)
-
-                db.execute("UPDATE schedules SET bus_stop_code=%s, description=%s, state='2' WHERE user_id=%s AND "
-                           "state='1'", (message, description, update.message.chat_id))
-            else:
-                update.message.reply_text("Bus Stop Code {} is not valid. Please check again.\n\n"
-                                          "Click/Type /exit to stop scheduling message.".format(message))
 
-        elif 'exit' in message:
-            update.message.reply_text('Quit Scheduling Message...')
-            db.execute("DELETE FROM schedules WHERE user_id=%s AND state='1'", (update.message.chat_id,))
-        else:
-            update.message.reply_text('{} is not a valid bus stop code. Bus stop code should be 5 digits. Please try '
-                                      'again!\n\nClick/Type /exit to stop scheduling message.'.format(message))
-
-    # Raise alert if user has not confirmed the bus numbers for scheduling message
-    elif schedule_buses:
-        if 'exit' in message:
-            update.message.reply_text('Quit Scheduling Message...')
-            db.execute("DELETE FROM schedules WHERE user_id=%s AND state='2'", (update.message.chat_id,))
-        else:
-            update.message.reply_text('Please select your bus timings you want to be notified on.\n\n'
-                                      'Click/Type /exit to stop scheduling message.')
-
-    # Deals with time when user is scheduling message
-    elif schedule_msg_time:
-        # [0-9] means the character is a number from 0 to 9
-        # ? means if the first number is 0 or 1, just take either, | means or operator
-        time_format = re.compile("^([01]?[0-9]|2[0-3])[0-5][0-9]$")
-        if re.search(time_format, message):
-            db.execute("SELECT * FROM schedules WHERE user_id=%s AND state='3'", (update.message.chat_id,))
-            bus_stop = db.fetchone()
-            bus_stop_code, description = bus_stop[1], bus_stop[2]
-            selected_buses = ''
-            for bus in bus_stop[5:10]:
-                # To check that it is not None or 'None'
-                if type(bus) == str and bus != "None":
-                    selected_buses += '{},'.format(bus)
-            # If not bus is selected, all buses will be shown
-            if selected_buses == '':
-                selected_buses = 'ALL'
-            else:
-                # Remove the last comma
-                selected_buses = selected_buses[:-1]
-            update.message.reply_text(schedule_confirm(message, description, bus_stop_code, selected_buses),
-                                      parse_mode=ParseMode.HTML)
-            message = '{}:{}'.format(message[:2], message[-2:])
-            db.execute("UPDATE schedules SET time=%s, state='0' WHERE user_id=%s AND state='3'",
-                       (message, update.message.chat_id))
-        elif 'exit' in message:
-            update.message.reply_text('Quit Scheduling Message...')
-            db.execute("DELETE FROM schedules WHERE user_id=%s AND state='3'", (update.message.chat_id,))
+def rename_bus_stop_input(update: Update, context: CallbackContext):
+    """
+    Bot is expecting a new name from user when users rename their bus stop (state=1 in users table)
+    """
+    if update.message.text == '/exit':
+        db.execute("UPDATE users SET state=0 WHERE user_id=%s AND state=1", (update.message.chat_id,))
+        conversation_states.discard(update.message.chat_id, RENAMING_BUS_STOP)
+        update.message.reply_text('Quit Renaming Bus Stop...')
+        return
+
+    renaming_bus_stop = db.fetchone("SELECT description FROM users WHERE user_id=%s AND state=1",
+                                    (update.message.chat_id,))
+    if renaming_bus_stop is None:
+        conversation_states.invalidate(update.message.chat_id)
+        return
+    new_name = update.message.text.upper()
+    update.message.reply_text("<b>Successful!</b>\nOriginal: <b>{}</b>\nNew: <b>{}</b>"
+                              .format(renaming_bus_stop[0], new_name), parse_mode=ParseMode.HTML)
+    db.execute("UPDATE users SET new_description=%s, state=0 WHERE user_id=%s AND description=%s",
+               (new_name, update.message.chat_id, renaming_bus_stop[0]))
+    # Other bus stops may still be waiting to be renamed
+    conversation_states.invalidate(update.message.chat_id)
+
+
+def feedback_input(update: Update, context: CallbackContext, message):
+    """
+    Bot is expecting a feedback from user (state=1 in feedback table)
+    """
+    # Ensure that user message is kind of appropriate. To be improved...
+    if len(message) > 5:
+        db.execute("UPDATE feedback SET user_feedback=%s, datetime=now(), state=0 WHERE user_id=%s AND state=1",
+                   (message, update.message.chat_id))
+        conversation_states.discard(update.message.chat_id, FEEDBACK)
+        update.message.reply_text('Thank you for your feedback!')
+    elif 'exit' in message:
+        db.execute("DELETE FROM feedback WHERE user_id=%s AND state=1", (update.message.chat_id,))
+        conversation_states.discard(update.message.chat_id, FEEDBACK)
+        update.message.reply_text('Quit Feedback Section...')
+    else:
+        update.message.reply_text('Please type in a feedback that is appropriate/longer.\n\n'
+                                  'Click/Type /exit to stop giving feedback.')
+
+
+def schedule_bus_stop_input(update: Update, context: CallbackContext, message):
+    """
+    Bot is expecting a bus stop code from user to schedule a message (state=1 in schedules table).
+    Change state=2 for schedules table. Expecting user for the bus numbers next.
+    """
+    if (len(message) == 5) and message.isdigit():
+        bus_stop = bus_stop_registry().get(message)
+        description = bus_stop.description if bus_stop else None
+
+        all_bus_services = [bus['ServiceNo'] for bus in bus_arrival(message)]
+        if description:
+            # To delete any duplicates
+            if SCHEDULE_BUSES in conversation_states.pending(update.message.chat_id):
+                db.execute("DELETE FROM schedules WHERE user_id=%s AND state=2", (update.message.chat_id,))
+
+            bot_typing(context.bot, update.message.chat_id)
+
+            # Keyboard display for all the bus numbers of a bus stop, the buttons only carry a token
+            selection = keyboard_states.create(message, all_bus_services)
+            update.message.reply_text(schedule_bus_number(message, selection.selected_text()),
+                                      reply_markup=selection.reply_markup, parse_mode=ParseMode.HTML)
+
+            db.execute("UPDATE schedules SET bus_stop_code=%s, description=%s, state=2 WHERE user_id=%s AND state=1",
+                       (message, description, update.message.chat_id))
+            conversation_states.discard(update.message.chat_id, SCHEDULE_BUS_STOP)
+            conversation_states.add(update.message.chat_id, SCHEDULE_BUSES)
         else:
-            update.message.reply_text(schedule_timing_failed(), parse_mode=ParseMode.HTML)
+            update.message.reply_text("Bus Stop Code {} is not valid. Please check again.\n\n"
+                                      "Click/Type /exit to stop scheduling message.".format(message))
 
+    elif 'exit' in message:
+        update.message.reply_text('Quit Scheduling Message...')
+        db.execute("DELETE FROM schedules WHERE user_id=%s AND state=1", (update.message.chat_id,))
+        conversation_states.discard(update.message.chat_id, SCHEDULE_BUS_STOP)
     else:
-        # Assuming all bus codes have 5 digits
-        if (len(message) == 5) and message.isdigit():
-            description = None
-            with open('bus_stops.txt', 'r') as r:
-                for bus_stop in r.readlines():
-                    bus_stop_location = bus_stop.split(' | ', 5)
-                    if bus_stop_location[0] == message:
-                        description = bus_stop_location[2]
-                        latitude = float(bus_stop_location[3])
-                        longitude = float(bus_stop_location[4])
-                        break
-            if description is not None:
-                keyboard = [['Change Stop'], ['Add to Favourites ❤']]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-                context.bot.send_location(chat_id=update.message.chat_id, latitude=latitude, longitude=longitude,
-                                          reply_markup=reply_markup)
-
-                bus_message = short_bus_timing_message(message)
-                update.message.reply_text(bus_message[0], reply_markup=bus_message[1], parse_mode=ParseMode.HTML)
-
-                db.execute('INSERT INTO bus_stop_code_history (user_id, bus_stop_code, description, datetime)'
-                           'VALUES (%s, %s, %s, %s) ON CONFLICT (user_id, bus_stop_code) DO UPDATE SET '
-                           'datetime=%s',
-                           (update.message.chat_id, bus_message[3], description,
-                            str(datetime.utcnow() + timedelta(hours=8)).split('.')[0],
-                            str(datetime.utcnow() + timedelta(hours=8)).split('.')[0]))
-            else:
-                update.message.reply_text('{} is not a valid bus stop code. Please try again!'.format(message))
-
-        # Assuming bus number has <=4 numbers/alphabets
-        elif (len(message) <= 4) and has_numbers(message):
-            bus_number_list = set()
-            with open('bus_routes.txt', 'r') as r:
-                for bus_stop in r.readlines():
-                    bus_number_list.add(bus_stop.split(' | ')[0])
-
-            if message in bus_number_list:
-                keyboard = [[InlineKeyboardButton('Bus Routes', callback_data='callback_routes')]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                update.message.reply_text('Bus /{}'.format(message), reply_markup=reply_markup)
-            else:
-                update.message.reply_text('There is currently no data for bus number {}!'.format(message.upper()))
-
-        # Assume user types in a location keyword
-        elif re.sub('[^A-Za-z0-9]+', '', message).isalnum() and (len(message) >= 5):
-            possible_locations = set()
-            with open('bus_stops.txt', 'r') as r:
-                for bus_stop in r.readlines():
-                    attributes = bus_stop.split(' | ', 5)
-
-                    # Find the similarity ratio between official road name and message
-                    road_name = attributes[1]
-                    s = SequenceMatcher(None, message, road_name.lower())
-                    # Ratio must be above 75% for road name to be accepted
-                    if s.ratio() > 0.75 or message in road_name.lower():
-                        if len(possible_locations) <= 20:
-                            possible_locations.add(bus_stop)
-
-                    # Find the similarity ratio between official bus stop name and message
-                    bus_stop_name = attributes[2]
-                    s = SequenceMatcher(None, message, bus_stop_name.lower())
-                    # Ratio must be above 75% for bus stop name to be accepted
-                    if s.ratio() > 0.75 or message in bus_stop_name.lower():
-                        if len(possible_locations) <= 20:
-                            possible_locations.add(bus_stop)
-
-            # If there is at least 1 location that matches what the user inputted
-            if possible_locations:
-                location_message = "<b>Possible Location:</b>\n\n" \
-                                   "Click on any of the bus stop codes\n" \
-                                   "below to get the bus arrival timings\n" \
-                                   "for that bus stop!\n\n"
-
-                for possible_location in possible_locations:
-                    possible_location = possible_location.split(' | ', 5)
-                    location_message += "<b>{}</b>\n{} (/{})\n\n".format(possible_location[2], possible_location[1],
-                                                                         possible_location[0])
-                keyboard = [['Change Stop'], ['Add to Favourites ❤']]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-                update.message.reply_text(location_message, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-            else:
-                update.message.reply_text(cannot_understand())
-        # If bot cannot understand user's message
+        update.message.reply_text('{} is not a valid bus stop code. Bus stop code should be 5 digits. Please try '
+                                  'again!\n\nClick/Type /exit to stop scheduling message.'.format(message))
+
+
+def schedule_buses_input(update: Update, context: CallbackContext, message):
+    """
+    Bot is expecting bus numbers from user to schedule a message (state=2 in schedules table).
+    Raise alert if user has not confirmed the bus numbers for scheduling message
+    """
+    if 'exit' in message:
+        update.message.reply_text('Quit Scheduling Message...')
+        db.execute("DELETE FROM schedules WHERE user_id=%s AND state=2", (update.message.chat_id,))
+        conversation_states.discard(update.message.chat_id, SCHEDULE_BUSES)
+    else:
+        update.message.reply_text('Please select your bus timings you want to be notified on.\n\n'
+                                  'Click/Type /exit to stop scheduling message.')
+
+
+def schedule_time_input(update: Update, context: CallbackContext, message):
+    """
+    Bot is expecting a time from user to schedule a message (state=3 in schedules table)
+    """
+    # [0-9] means the character is a number from 0 to 9
+    # ? means if the first number is 0 or 1, just take either, | means or operator
+    time_format = re.compile("^([01]?[0-9]|2[0-3])[0-5][0-9]$")
+    if re.search(time_format, message):
+        bus_stop = db.fetchone("SELECT bus_stop_code, description, buses FROM schedules WHERE user_id=%s AND state=3",
+                               (update.message.chat_id,))
+        if bus_stop is None:
+            conversation_states.invalidate(update.message.chat_id)
+            return
+        bus_stop_code, description, buses = bus_stop
+        # If not bus is selected, all buses will be shown
+        selected_buses = ','.join(buses) or 'ALL'
+        update.message.reply_text(schedule_confirm(message, description, bus_stop_code, selected_buses),
+                                  parse_mode=ParseMode.HTML)
+        # 730 is 07:30
+        message = '{}:{}'.format(message.zfill(4)[:2], message[-2:])
+        db.execute("UPDATE schedules SET time=%s, state=0 WHERE user_id=%s AND state=3",
+                   (message, update.message.chat_id))
+        conversation_states.discard(update.message.chat_id, SCHEDULE_TIME)
+        schedule_wheel.add(update.message.chat_id, bus_stop_code, message, buses)
+    elif 'exit' in message:
+        update.message.reply_text('Quit Scheduling Message...')
+        db.execute("DELETE FROM schedules WHERE user_id=%s AND state=3", (update.message.chat_id,))
+        conversation_states.discard(update.message.chat_id, SCHEDULE_TIME)
+    else:
+        update.message.reply_text(schedule_timing_failed(), parse_mode=ParseMode.HTML)
+
+
+def bus_query_input(update: Update, context: CallbackContext, message):
+    """
+    Bot is not waiting for a reply: user has typed a bus stop code, bus number or location
+    """
+    # Assuming all bus codes have 5 digits
+    if (len(message) == 5) and message.isdigit():
+        bus_stop = bus_stop_registry().get(message)
+        if bus_stop is not None:
+            description = bus_stop.description
+            keyboard = [['Change Stop'], ['Add to Favourites ❤']]
+            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+            context.bot.send_location(chat_id=update.message.chat_id, latitude=bus_stop.latitude,
+                                      longitude=bus_stop.longitude, reply_markup=reply_markup)
+
+            bus_message = short_bus_timing_message(message)
+            update.message.reply_text(bus_message[0], reply_markup=bus_message[1], parse_mode=ParseMode.HTML)
+
+            write_behind.put('bus_stop_code_history', (update.message.chat_id, bus_message[3], description,
+                                                       datetime.now(timezone.utc)))
+        else:
+            update.message.reply_text('{} is not a valid bus stop code. Please try again!'.format(message))
+
+    # Assuming bus number has <=4 numbers/alphabets
+    elif (len(message) <= 4) and has_numbers(message):
+        bus_number = message.upper()
+        if bus_number in route_index():
+            keyboard = [[InlineKeyboardButton('Bus Routes', callback_data='callback_routes')]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            update.message.reply_text('Bus /{}'.format(bus_number), reply_markup=reply_markup)
+        else:
+            update.message.reply_text('There is currently no data for bus number {}!'.format(bus_number))
+
+    # Assume user types in a location keyword
+    elif re.sub('[^A-Za-z0-9]+', '', message).isalnum() and (len(message) >= 5):
+        possible_locations = bus_stop_registry().search(message, compat=LOCATION_SEARCH_COMPAT)
+
+        # If there is at least 1 location that matches what the user inputted
+        if possible_locations:
+            location_message = "<b>Possible Location:</b>\n\n" \
+                               "Click on any of the bus stop codes\n" \
+                               "below to get the bus arrival timings\n" \
+                               "for that bus stop!\n\n"
+
+            for possible_location in possible_locations:
+                location_message += "<b>{}</b>\n{} (/{})\n\n".format(possible_location.description,
+                                                                     possible_location.road_name,
+                                                                     possible_location.code)
+            keyboard = [['Change Stop'], ['Add to Favourites ❤']]
+            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+            update.message.reply_text(location_message, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         else:
             update.message.reply_text(cannot_understand())
+    # If bot cannot understand user's message
+    else:
+        update.message.reply_text(cannot_understand())
+
+
+# Handlers for the replies that the bot is waiting for, renaming is handled before the message is lowercased
+STATE_HANDLERS = {
+    FEEDBACK: feedback_input,
+    SCHEDULE_BUS_STOP: schedule_bus_stop_input,
+    SCHEDULE_BUSES: schedule_buses_input,
+    SCHEDULE_TIME: schedule_time_input,
+}
 
 
 def show_favourites(update: Update, context: CallbackContext):
@@ -354,11 +324,11 @@ def show_favourites(update: Update, context: CallbackContext):
     Show bus stop codes that users had previously added to favourites for convenience
     """
     bot_typing(context.bot, update.message.chat_id)
-    db.execute('SELECT DISTINCT * FROM users WHERE user_id=%s', (update.message.chat_id,))
-    favourites = db.fetchall()
+    favourites = db.fetchall('SELECT bus_stop_code, new_description FROM users WHERE user_id=%s',
+                             (update.message.chat_id,))
     if favourites:
         for favourite in favourites:
-            message = '<b>{}\nBus Stop Code: /{}</b>'.format(favourite[3], favourite[1])
+            message = '<b>{}\nBus Stop Code: /{}</b>'.format(favourite[1], favourite[0])
             keyboard = [
                 [InlineKeyboardButton('Select', callback_data='select_favourite'),
                  InlineKeyboardButton('Delete', callback_data='delete_favourite')],
@@ -366,6 +336,9 @@ def show_favourites(update: Update, context: CallbackContext):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             update.message.reply_text(message, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        keyboard = [[InlineKeyboardButton('All Favourites', callback_data='favourites_dashboard')]]
+        update.message.reply_text('Get the bus timings of all your favourite bus stops in one message',
+                                  reply_markup=InlineKeyboardMarkup(keyboard))
     else:
         update.message.reply_text(no_fav_msg())
 
@@ -378,9 +351,10 @@ def add_favourites(update: Update, context: CallbackContext):
     try:
         message = update.message.text.split(' ')[1]
         if update.message.text == 'Add to Favourites ❤':
-            db.execute('SELECT * FROM bus_stop_code_history WHERE user_id = %s ORDER BY datetime DESC',
-                       (update.message.chat_id,))
-            last_sent_code = db.fetchone()
+            # The last bus stop code may not have been written yet
+            write_behind.flush('bus_stop_code_history')
+            last_sent_code = db.fetchone('SELECT user_id, bus_stop_code, description FROM bus_stop_code_history '
+                                         'WHERE user_id=%s ORDER BY datetime DESC LIMIT 1', (update.message.chat_id,))
 
             db.execute("INSERT INTO users (user_id, bus_stop_code, description, new_description, state) VALUES "
                        "(%s, %s, %s, %s, '0') ON CONFLICT (user_id, bus_stop_code) DO NOTHING",
@@ -388,19 +362,15 @@ def add_favourites(update: Update, context: CallbackContext):
 
             update.message.reply_text(add_favourites_msg(last_sent_code[1]), parse_mode=ParseMode.HTML)
 
-        elif len(message) == 5 and message.isdigit():
-            with open('bus_stops.txt', 'r') as r:
-                for bus_stop in r.readlines():
-                    bus_stop_location = bus_stop.split(' | ', 5)
-                    if bus_stop_location[0] == message:
-                        description = bus_stop_location[2]
+        elif len(message) == 5 and message.isdigit() and message in bus_stop_registry():
+            description = bus_stop_registry().get(message).description
             db.execute("INSERT INTO users (user_id, bus_stop_code, description, new_description, state) VALUES "
                        "(%s, %s, %s, %s, '0') ON CONFLICT (user_id, bus_stop_code) DO NOTHING",
                        (update.message.chat_id, message, description, description))
 
             update.message.reply_text(add_favourites_msg(message), parse_mode=ParseMode.HTML)
 
-        elif len(message) != 5 and not message.isdigit():
+        else:
             update.message.reply_text(failed_add_fav_msg(message))
     except IndexError:
         update.message.reply_text(instructions_add_fav())
@@ -410,8 +380,19 @@ def buttons_functions(update: Update, context: CallbackContext):
     """
     Deals with inline keyboard button
     """
+    # Bus timings of all the favourite bus stops in one message
+    if update.callback_query.data == 'favourites_dashboard':
+        favourites = db.fetchall('SELECT bus_stop_code, new_description FROM users WHERE user_id=%s',
+                                 (update.effective_message.chat_id,))
+        if favourites:
+            bus_message = favourites_dashboard_message(favourites)
+            update.callback_query.edit_message_text(bus_message[0], reply_markup=bus_message[1],
+                                                    parse_mode=ParseMode.HTML)
+        else:
+            update.callback_query.edit_message_text(no_fav_msg())
+
     # For bus timing messages
-    if 'Wheel-chair Accessible' in update.callback_query.message['text']:
+    elif 'Wheel-chair Accessible' in update.callback_query.message['text']:
         bus_code = update.callback_query.message['text'].split('Bus Stop Code: /')[1][:5]
         display_format = update.callback_query.message['text'].split('Format: ')[1].split('\n')[0]
         if update.callback_query.data == 'callback_format':
@@ -430,15 +411,9 @@ def buttons_functions(update: Update, context: CallbackContext):
     elif update.callback_query.data == 'callback_routes':
         bus_number = update.callback_query.message['text'].split('/')[1]
         message = '<b>Bus /{}</b>\n\n'.format(bus_number)
-        direction1, direction2 = '', ''
-        with open('bus_routes.txt', 'r') as r:
-            for bus in r.readlines():
-                attributes = bus.split(' | ', 9)
-                if bus_number == attributes[0]:
-                    if attributes[1] == '1':
-                        direction1 += '{} (/{})\n'.format(attributes[3], attributes[2])
-                    if attributes[1] == '2':
-                        direction2 += '{} (/{})\n'.format(attributes[3], attributes[2])
+        route = route_index().route(bus_number)
+        direction1 = ''.join('{} (/{})\n'.format(name, code) for code, name in route.get('1', list()))
+        direction2 = ''.join('{} (/{})\n'.format(name, code) for code, name in route.get('2', list()))
 
         first_stop = direction1.split('(')[0]
         direction1 = '<b>From {}:</b>\n{}'.format(first_stop, direction1)
@@ -458,15 +433,16 @@ def buttons_functions(update: Update, context: CallbackContext):
         bus_stop_code = update.callback_query.message['text'].rsplit('/')[-1]
         db.execute('DELETE FROM users WHERE user_id=%s AND bus_stop_code=%s', (update.callback_query.message.chat_id,
                                                                                bus_stop_code))
+        conversation_states.invalidate(update.callback_query.message.chat_id)
         update.callback_query.edit_message_text(delete_fav_msg(bus_stop_code))
 
     # To allow users to rename their favourite bus stop
     elif update.callback_query.data == 'rename_bus_stop':
         bus_stop_code = update.callback_query.message['text'].rsplit('/')[-1]
-        db.execute("UPDATE users SET state='1' WHERE user_id=%s AND bus_stop_code=%s RETURNING description, "
-                   "new_description",
-                   (update.callback_query.message.chat_id, bus_stop_code))
-        descriptions = db.fetchone()
+        descriptions = db.fetchone("UPDATE users SET state=1 WHERE user_id=%s AND bus_stop_code=%s RETURNING "
+                                   "description, new_description",
+                                   (update.callback_query.message.chat_id, bus_stop_code))
+        conversation_states.add(update.callback_query.message.chat_id, RENAMING_BUS_STOP)
         description, new_description = descriptions[0], descriptions[1]
         if description == new_description:
             update.effective_message.reply_text('<b>Renaming in process:</b>\nPlease rename <b>{}</b>.\n\nClick/Type '
@@ -483,29 +459,28 @@ def buttons_functions(update: Update, context: CallbackContext):
     elif update.callback_query.data == 'schedule_message':
         update.effective_message.reply_text('Enter 5 digit bus stop code:\ne.g: 14141\n\n'
                                             'Click/Type /exit to stop scheduling message.', reply_markup=ForceReply())
-        db.execute("INSERT INTO schedules (user_id, bus_stop_code, time, state) VALUES (%s, '-', '-', 1) ON CONFLICT "
-                   "(user_id, bus_stop_code, time, state) DO NOTHING", (update.effective_message.chat_id,))
+        db.execute("INSERT INTO schedules (user_id, state) VALUES (%s, 1) "
+                   "ON CONFLICT (user_id, state) WHERE state <> 0 DO NOTHING", (update.effective_message.chat_id,))
+        conversation_states.add(update.effective_message.chat_id, SCHEDULE_BUS_STOP)
 
     # To allow users to view their schedules
     elif update.callback_query.data == 'view_schedules':
-        db.execute("SELECT * FROM schedules WHERE user_id=%s AND state='0'", (update.effective_message.chat_id,))
-        schedules = db.fetchall()
+        schedules = db.fetchall("SELECT bus_stop_code, description, time, buses FROM schedules WHERE user_id=%s AND "
+                                "state=0 ORDER BY time", (update.effective_message.chat_id,))
         # TODO: show buses that are being scheduled
         if schedules:
             update.effective_message.reply_text('View Scheduled Messages')
         else:
             update.effective_message.reply_text('No Scheduled Messages.\n\nTo schedule a message, click on the '
                                                 '"Schedule Message" button.')
-        for index, schedule in enumerate(schedules):
-            # To check that buses_selected is not None or 'None'
-            buses_selected = ','.join("".join(str(elem)) for elem in schedule[5:10] if type(elem) == str and
-                                      elem != 'None')
-            if buses_selected == '':
-                buses_selected = 'ALL'
+        for bus_stop_code, description, schedule_time, buses in schedules:
+            buses_selected = ','.join(buses) or 'ALL'
+            schedule_time = schedule_time.strftime('%H:%M')
             keyboard = [[InlineKeyboardButton('Remove', callback_data='remove_scheduled_message-{}'
-                                              .format(schedule[3]))]]
+                                              .format(schedule_time))]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            update.effective_message.reply_text(view_schedules(schedule[2], schedule[1], buses_selected, schedule[3]),
+            update.effective_message.reply_text(view_schedules(description, bus_stop_code, buses_selected,
+                                                               schedule_time),
                                                 reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     # To allow users to delete their schedules
@@ -518,103 +493,47 @@ def buttons_functions(update: Update, context: CallbackContext):
 
         db.execute('DELETE FROM schedules WHERE user_id=%s AND time=%s', (update.effective_message.chat['id'],
                                                                           msg_time))
+        schedule_wheel.remove(update.effective_message.chat['id'], msg_time)
         update.callback_query.edit_message_text("Schedule for {} removed.\n\nTo schedule a new message, click on the "
                                                 "'Schedule Message' button in /settings!".format(bus_stop))
 
     # User chooses the bus number they want to see when they schedule message
     elif update.callback_query.data.startswith('bus_'):
-        # Bus number that user selected mostly recently
-        bus_number = update.callback_query.data.split('_')[1]
-        # All the bus numbers that user had selected previously
-        bus_services_data = update.callback_query.data.split('_')[2]
-        # Convert all the bus numbers that user had selected previously into list
-        all_bus_services = bus_services_data.split(',')
-
-        keyboard, sublist = list(), list()
-
-        for bus_service in all_bus_services:
-            if len(sublist) < 3:
-                sublist.append(InlineKeyboardButton(bus_service, callback_data='bus_{}_{}'.format(bus_service,
-                                                                                                  bus_services_data)))
-            if len(sublist) == 3:
-                keyboard.append(sublist)
-                sublist = list()
-
-        num_rows = len(all_bus_services) % 3
-        if num_rows == 2:
-            keyboard.append([InlineKeyboardButton(all_bus_services[-2],
-                                                  callback_data='bus_{}_{}'.format(all_bus_services[-2],
-                                                                                   bus_services_data)),
-                             InlineKeyboardButton(all_bus_services[-1],
-                                                  callback_data='bus_{}_{}'.format(all_bus_services[-1],
-                                                                                   bus_services_data)),
-                             InlineKeyboardButton('Confirm', callback_data='confirm_bus_num')])
-        elif num_rows == 1:
-            keyboard.append([InlineKeyboardButton(all_bus_services[-1],
-                                                  callback_data='bus_{}_{}'.format(all_bus_services[-1],
-                                                                                   bus_services_data)),
-                             InlineKeyboardButton('Confirm', callback_data='confirm_bus_num')])
-        else:
-            keyboard.append([InlineKeyboardButton('Confirm', callback_data='confirm_bus_num')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        message = update.effective_message.text
-        all_selected_buses = message.split(':')[-1]
-        bus_stop_code = message.strip('Bus Stop Code ')[:5]
-        # If user previously does not have any selected bus
-        if 'None' in all_selected_buses:
-            selected_bus = bus_number
-
-        # If user removes a bus and there is no selected bus now
-        elif bus_number == all_selected_buses or bus_number == all_selected_buses[1:]:
-            selected_bus = 'None'
-
-        # If user removes a bus and there are still other selected buses
-        elif bus_number in all_selected_buses.split(','):
-            buses = all_selected_buses.split(',')
-            buses.remove(bus_number)
-            selected_bus = ','.join(buses)
-
-        # If user selects a new bus number
-        else:
-            selected_bus = "{},{}".format(all_selected_buses, bus_number)
-
-        # Remove the extra comma in front if user removes the first bus he has selected
-        if selected_bus[0] == ',':
-            selected_bus = selected_bus[1:]
-        if len(selected_bus.split(',')) > 5:
-            selected_bus = selected_bus.split(',', 1)[1]
-        update.effective_message.edit_text(schedule_bus_number(bus_stop_code, selected_bus),
-                                           parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        # 'bus_<token>_<index of the bus number>'
+        _, token, index = update.callback_query.data.split('_', 2)
+        selection = keyboard_states.toggle(token, int(index)) if index.isdigit() else None
+        if selection is None:
+            update.effective_message.edit_text('This selection has expired. Please schedule your message again in '
+                                               '/settings.')
+            return
+        update.effective_message.edit_text(schedule_bus_number(selection.bus_stop_code, selection.selected_text()),
+                                           parse_mode=ParseMode.HTML, reply_markup=selection.reply_markup)
 
     # After users confirm the bus number to be scheduled
-    elif update.callback_query.data == 'confirm_bus_num':
-        bus_stop_code = update.effective_message.text.strip('Bus Stop Code ')[:6]
-        # Convert into tuple format for inserting into database
-        selected_buses = tuple(update.effective_message.text.split(':')[1].split(","))
-        # If at least a bus is selected previously
-        if selected_buses != ('None',):
-            while len(selected_buses) != 5:
-                selected_buses += ('None',)
-
-            update.effective_message.edit_text(schedule_timing(bus_stop_code), reply_markup=None,
-                                               parse_mode=ParseMode.HTML)
-
-            db.execute("SELECT * FROM schedules WHERE user_id=%s AND state='2'", (update.effective_message.chat_id,))
-            user = db.fetchone()
-            # Get the first 4 elements of the user
-            # Find a better way to code this... UPDATE AND ON CONFLICT not allowed
-            selected_buses = user[0:4] + ('3',) + selected_buses
-            db.execute("DELETE FROM schedules WHERE user_id=%s AND state='2'", (update.effective_message.chat_id,))
-            db.execute("INSERT INTO schedules VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT "
-                       "(user_id, bus_stop_code, time, state) DO NOTHING", selected_buses)
-
-        # If user did not select a bus - default option (ALL BUS SELECTED)
+    elif update.callback_query.data.startswith('confirm_bus_num'):
+        # 'confirm_bus_num_<token>', or 'confirm_bus_num' on keyboards sent before the selection was kept here
+        token = update.callback_query.data[len('confirm_bus_num_'):]
+        selection = keyboard_states.get(token)
+        if selection is not None:
+            keyboard_states.discard(token)
+            bus_stop_code, selected_buses = selection.bus_stop_code, selection.selected
         else:
-            update.effective_message.edit_text(schedule_timing(bus_stop_code), reply_markup=None,
-                                               parse_mode=ParseMode.HTML,)
-            db.execute("UPDATE schedules SET state='3' WHERE user_id=%s AND state='2'",
-                       (update.effective_message.chat_id, ))
+            # The selection is also shown in the message
+            bus_stop_code = update.effective_message.text.strip('Bus Stop Code ')[:5]
+            selected_buses = update.effective_message.text.split(':')[-1].split(",")
+            # If user did not select a bus - default option (ALL BUS SELECTED)
+            if selected_buses == ['None']:
+                selected_buses = list()
+
+        update.effective_message.edit_text(schedule_timing(bus_stop_code), reply_markup=None,
+                                           parse_mode=ParseMode.HTML)
+        # Only one schedule waits for a time at once
+        with db.transaction() as cursor:
+            cursor.execute("DELETE FROM schedules WHERE user_id=%s AND state=3", (update.effective_message.chat_id,))
+            cursor.execute("UPDATE schedules SET buses=%s, state=3 WHERE user_id=%s AND state=2",
+                           (selected_buses, update.effective_message.chat_id))
+        conversation_states.discard(update.effective_message.chat_id, SCHEDULE_BUSES)
+        conversation_states.add(update.effective_message.chat_id, SCHEDULE_TIME)
 
     # User chooses to receive MRT alerts during MRT breakdowns/delays
     elif update.callback_query.data == 'accept_mrt_alerts':
@@ -625,6 +544,7 @@ def buttons_functions(update: Update, context: CallbackContext):
         update.effective_message.edit_text('Do you want to receive MRT alert messages in the event of MRT '
                                            'breakdowns/delays?\n\nYour current answer is: <b>Yes</b>',
                                            reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        write_behind.flush('all_users')
         db.execute("UPDATE all_users SET receive_alerts='Yes' WHERE user_id=%s", (update.effective_message.chat_id, ))
 
     # User chooses not to receive MRT alerts during MRT breakdowns/delays
@@ -636,6 +556,7 @@ def buttons_functions(update: Update, context: CallbackContext):
         update.effective_message.edit_text('Do you want to receive MRT alert messages in the event of MRT '
                                            'breakdowns/delays?\n\nYour current answer is: <b>No</b>',
                                            reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        write_behind.flush('all_users')
         db.execute("UPDATE all_users SET receive_alerts='No' WHERE user_id=%s", (update.effective_message.chat_id, ))
 
     # To update users on any mrt alerts
@@ -644,7 +565,7 @@ def buttons_functions(update: Update, context: CallbackContext):
 
     # To send users an image of the mrt map
     elif update.callback_query.data == 'mrt_map':
-        context.bot.send_photo(chat_id=update.effective_message.chat_id, photo=open('mrt_image.jpg', 'rb'))
+        media_cache.send_photo(context.bot, update.effective_message.chat_id, 'mrt_image.jpg')
 
 
 def feedback(update: Update, context: CallbackContext):
@@ -653,8 +574,9 @@ def feedback(update: Update, context: CallbackContext):
     """
     bot_typing(context.bot, update.message.chat_id)
     update.message.reply_text(prompt_feedback_msg())
-    db.execute("INSERT INTO feedback (user_id, user_feedback, datetime, state) VALUES (%s, '-', '-', '1') ON CONFLICT "
-               "(user_id, user_feedback, datetime, state) DO NOTHING", (update.message.chat_id,))
+    db.execute("INSERT INTO feedback (user_id, state) VALUES (%s, 1) ON CONFLICT (user_id) WHERE state <> 0 DO NOTHING",
+               (update.message.chat_id,))
+    conversation_states.add(update.message.chat_id, FEEDBACK)
 
 
 def settings(update: Update, context: CallbackContext):
@@ -669,8 +591,8 @@ def settings(update: Update, context: CallbackContext):
     update.message.reply_text('Set reminders for your bus timings at a scheduled time daily!',
                               reply_markup=reply_markup)
 
-    db.execute("SELECT * FROM all_users WHERE user_id=%s", (update.message.chat_id, ))
-    option = db.fetchone()[2]
+    write_behind.flush('all_users')
+    option = db.fetchone("SELECT receive_alerts FROM all_users WHERE user_id=%s", (update.message.chat_id, ))[0]
 
     keyboard = [[InlineKeyboardButton('Yes', callback_data='accept_mrt_alerts'),
                  InlineKeyboardButton('No', callback_data='reject_mrt_alerts')]]
@@ -694,7 +616,7 @@ def view_mrt(update: Update, context: CallbackContext):
 
 
 # def photo(update: Update, context: CallbackContext):
-#     db.execute("SELECT * FROM feedback WHERE user_id=%s AND state='1'", (update.message.chat_id,))
+#     db.execute("SELECT * FROM feedback WHERE user_id=%s AND state=1", (update.message.chat_id,))
 #     if db.fetchone() is not None:
 #         photo_file = update.message.photo[-1].get_file()
 #
@@ -707,20 +629,47 @@ def view_mrt(update: Update, context: CallbackContext):
 #         os.remove('user_photo.jpg')
 
 
+def load_schedules():
+    """
+    Load every confirmed schedule into schedule_wheel
+    """
+    schedule_wheel.load(db.fetchall("SELECT user_id, bus_stop_code, time, buses FROM schedules WHERE state=0"))
+    logger.info('Loaded %s scheduled messages', len(schedule_wheel))
+
+
 def send_scheduled_msg(context: CallbackContext):
     """
-    This function is being called every minute to send bus arrival timings to users if they schedule it
+    This function is being called at the start of every minute to send bus arrival timings to users if they schedule
+    it. Each bus stop is fetched once and each message is rendered once per (bus stop, selected buses), then all the
+    messages are sent concurrently within Telegram's rate limits before the minute is over.
     """
-    # Time format is 21:54
-    db.execute("SELECT * FROM schedules WHERE time=%s", (str(datetime.utcnow() + timedelta(hours=8)).split(' ')[1].
-                                                         rsplit(':', 1)[0],))
-    users = db.fetchall()
+    # The job fires at about the start of the minute, so round to the nearest minute in case it fires slightly early
+    current_time = (datetime.utcnow() + timedelta(hours=8, seconds=30)).replace(second=0, microsecond=0)
+    deadline = monotonic() + (current_time + timedelta(minutes=1) -
+                              (datetime.utcnow() + timedelta(hours=8))).total_seconds()
+
+    schedules = dict()
+    for schedule in schedule_wheel.due(current_time.hour * 60 + current_time.minute):
+        schedules.setdefault(schedule.bus_stop_code, list()).append((schedule.user_id, tuple(sorted(schedule.buses))))
+    if not schedules:
+        return
+    bus_timings = get_many_bus_timings(schedules)
+
+    bus_messages, messages = dict(), list()
+    for bus_stop_code, bus_stop_schedules in schedules.items():
+        if bus_stop_code not in bus_timings:
+            continue
+        for user_id, buses_selected_list in bus_stop_schedules:
+            if (bus_stop_code, buses_selected_list) not in bus_messages:
+                bus_messages[(bus_stop_code, buses_selected_list)] = scheduled_bus_timing_format(
+                    bus_stop_code, list(buses_selected_list), bus_timings[bus_stop_code])
+            bus_message = bus_messages[(bus_stop_code, buses_selected_list)]
+            messages.append((user_id, {'text': bus_message[0], 'reply_markup': bus_message[1],
+                                       'parse_mode': ParseMode.HTML}))
 
-    for user in users:
-        buses_selected_list = list(filter(lambda x: type(x) == str and x != 'None', user[5:10]))
-        bus_message = scheduled_bus_timing_format(user[1], buses_selected_list)
-        context.bot.send_message(chat_id=user[0], text=bus_message[0], reply_markup=bus_message[1],
-                                 parse_mode=ParseMode.HTML)
+    result = broadcaster.send(context.bot, messages, deadline=deadline)
+    logger.info('Scheduled messages for %s: %s from %s bus stops', current_time.strftime('%H:%M'), result,
+                len(bus_timings))
 
 
 def update_mrt_alert(context: CallbackContext):
@@ -728,29 +677,19 @@ def update_mrt_alert(context: CallbackContext):
     This function is being called every 10 minutes to check for MRT alerts.
     If there is a new alert message, send it to all users
     """
-    db.execute("SELECT * FROM mrt_updates ORDER BY datetime DESC")
-    latest_msg = db.fetchone()
-    # If latest_msg is not None. None occurs when mrt_updates table is empty
-    if latest_msg is not None:
-        latest_msg = latest_msg[0]
-
-    if get_mrt_alerts() != latest_msg and get_mrt_alerts() != 'All Train Services Working Normally 👍':
-        db.execute("SELECT * FROM all_users WHERE receive_alerts='Yes'")
-        users = db.fetchall()
-        for user in users:
-            context.bot.send_message(chat_id=user[0], text=get_mrt_alerts())
-        db.execute("INSERT INTO mrt_updates VALUES (%s, %s) ON CONFLICT (message) DO NOTHING",
-                   (get_mrt_alerts(), str(datetime.utcnow() + timedelta(hours=8)).split('.')[0]))
+    write_behind.flush('all_users')
+    mrt_alert_poller.poll(context.bot)
 
 
 def update_bus_data(context: CallbackContext):
     """
     This function is being called daily at 23:00 SGT to update bus routes and bus stops
     """
-    logger.info("Updating Bus Route Now...")
-    bus_routes()
     logger.info("Updating Bus Data Now...")
     update_bus_stops()
+    logger.info("Updating Bus Route Now...")
+    bus_routes()
+    load_bus_index()
     logger.info("All updates complete")
 
 
@@ -778,7 +717,16 @@ def stop(update: Update, context: CallbackContext):
 
 
 def main():
-    updater = Updater(TOKEN, use_context=True)
+    migrate(db)
+    write_behind.start()
+    load_bus_index()
+    metrics.cache_ratios.register('arrival', lambda: (arrival_cache.hits + arrival_cache.shared, arrival_cache.misses))
+    metrics.cache_ratios.register('conversation_state', lambda: (conversation_states.hits, conversation_states.misses))
+    metrics.cache_ratios.register('media', lambda: (media_cache.reuses, media_cache.uploads))
+    metrics.start_server(METRICS_PORT)
+    # The pool the Updater gives its own bot, dispatcher workers + 4, plus one connection per broadcast worker
+    request = metrics.InstrumentedRequest(con_pool_size=DISPATCHER_WORKERS + 4 + broadcaster.workers)
+    updater = Updater(bot=Bot(TOKEN, request=request), workers=DISPATCHER_WORKERS, use_context=True)
     dispatcher = updater.dispatcher
     job = updater.job_queue
 
@@ -802,10 +750,15 @@ def main():
     dispatcher.add_handler(MessageHandler(Filters.text & Filters.regex('^Change Stop$'), nearest_locations))
     dispatcher.add_handler(MessageHandler(Filters.text & Filters.regex('^Add to Favourites ❤$'), add_favourites))
     dispatcher.add_error_handler(prevent_error)
-
-    job.run_repeating(send_scheduled_msg, interval=60)
-    job.run_repeating(update_mrt_alert, interval=620)
-    job.run_daily(update_bus_data,
+    metrics.instrument_dispatcher(dispatcher)
+
+    load_schedules()
+    # Start on the next minute boundary. The interval is anchored to the first run, so it does not drift.
+    current_time = datetime.utcnow()
+    job.run_repeating(metrics.job(send_scheduled_msg), interval=60,
+                      first=60 - current_time.second - current_time.microsecond / 1000000)
+    job.run_repeating(metrics.job(update_mrt_alert), interval=620)
+    job.run_daily(metrics.job(update_bus_data),
                   time=time(hour=21, minute=00, second=00, tzinfo=pytz.timezone('Asia/Singapore')),
                   days=(0, 1, 2, 3, 4, 5, 6))
 
@@ -0,0 +1,128 @@
+"""
+Uploads each static file the bot sends once and reuses the file_id Telegram returns
+"""
+import hashlib
+import logging
+import os
+import threading
+
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# Bot method used to send each kind of media, and how to read the file_id back from the sent message
+SENDERS = {
+    'photo': ('send_photo', lambda message: message.photo[-1].file_id),
+    'document': ('send_document', lambda message: message.document.file_id),
+    'animation': ('send_animation', lambda message: message.animation.file_id),
+}
+
+
+def file_hash(path):
+    """
+    :param str path: Path of the file
+    :return: SHA-256 of the file's contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as r:
+        for chunk in iter(lambda: r.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """
+    file_ids are stored with the content hash of the file in the media_files table, so they survive restarts and
+    are shared by every dyno. The hash of each file is only recomputed when its size or modification time changes;
+    a file whose contents changed is uploaded again. A file_id that Telegram no longer accepts, e.g. after the bot
+    token changed, is also replaced by uploading the file again.
+    """
+    def __init__(self, db):
+        """
+        :param database.Database db: Database with the media_files table
+        """
+        self._db = db
+        # path -> (size, mtime, content hash)
+        self._hashes = dict()
+        # path -> (content hash, file_id)
+        self._file_ids = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.reuses = 0
+
+    def send(self, bot, chat_id, path, kind='photo', **kwargs):
+        """
+        Send a static file, uploading it only if it has not been uploaded with the same contents before
+        :param bot: telegram.Bot
+        :param int chat_id: Chat to send to
+        :param str path: Path of the file
+        :param str kind: Key of SENDERS
+        :param kwargs: Extra arguments for the bot method, e.g. caption
+        :return: telegram.Message
+        """
+        method, get_file_id = SENDERS[kind]
+        send = getattr(bot, method)
+        content_hash = self._content_hash(path)
+
+        known = self._file_id(path, content_hash)
+        if known is not None:
+            try:
+                message = send(chat_id, known, **kwargs)
+                self.reuses += 1
+                return message
+            except BadRequest as e:
+                logger.warning('Uploading %s again, file_id was rejected: %s', path, e)
+
+        with self._path_lock(path):
+            # Another thread may have uploaded it while this one waited
+            file_id = self._file_id(path, content_hash)
+            if file_id is not None and file_id != known:
+                self.reuses += 1
+                return send(chat_id, file_id, **kwargs)
+            with open(path, 'rb') as r:
+                message = send(chat_id, r, **kwargs)
+            self.uploads += 1
+            self._save(path, content_hash, get_file_id(message))
+            return message
+
+    def send_photo(self, bot, chat_id, path, **kwargs):
+        """
+        :param bot: telegram.Bot
+        :param int chat_id: Chat to send to
+        :param str path: Path of the image
+        :param kwargs: Extra arguments for send_photo, e.g. caption
+        :return: telegram.Message
+        """
+        return self.send(bot, chat_id, path, 'photo', **kwargs)
+
+    def _content_hash(self, path):
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        content_hash = file_hash(path)
+        self._hashes[path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+        return content_hash
+
+    def _file_id(self, path, content_hash):
+        cached = self._file_ids.get(path)
+        if cached is not None and cached[0] == content_hash:
+            return cached[1]
+        row = self._db.fetchone('SELECT file_id FROM media_files WHERE path=%s AND content_hash=%s',
+                                (path, content_hash))
+        if row is None:
+            return None
+        self._file_ids[path] = (content_hash, row[0])
+        return row[0]
+
+    def _save(self, path, content_hash, file_id):
+        self._db.execute('INSERT INTO media_files (path, content_hash, file_id) VALUES (%s, %s, %s) '
+                         'ON CONFLICT (path) DO UPDATE SET content_hash=EXCLUDED.content_hash, '
+                         'file_id=EXCLUDED.file_id, uploaded_at=now()', (path, content_hash, file_id))
+        self._file_ids[path] = (content_hash, file_id)
+        logger.info('Uploaded %s as %s', path, file_id)
+
+    def _path_lock(self, path):
+        with self._lock:
+            return self._locks.setdefault(path, threading.Lock())
@@ -0,0 +1,316 @@
+"""
+Latency histograms, error counters and cache hit ratios of the bot, served in the Prometheus text format
+"""
+import logging
+import threading
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+from telegram.ext import DispatcherHandlerStop
+from telegram.utils.request import Request
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the histogram buckets, from a cached reply to a slow DataMall call
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _label(name, value):
+    # Metrics without a label have a single series
+    if name is None:
+        return ''
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{}="{}"'.format(name, value)
+
+
+def _braces(label):
+    return '{{{}}}'.format(label) if label else ''
+
+
+class Histogram:
+    """
+    Durations by one label, counted into BUCKETS
+    """
+    def __init__(self, name, help_text, label, buckets=BUCKETS):
+        """
+        :param str name: Metric name
+        :param str help_text: Description shown by Prometheus
+        :param str label: Name of the label, e.g. 'handler', or None for a single series
+        :param tuple buckets: Sorted upper bounds in seconds
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        # label value -> [count in each bucket and one for +Inf, sum]
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        """
+        :param label_value: Value of the label
+        :param float seconds: Duration to record
+        """
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def render(self):
+        """
+        :return: List of lines in the Prometheus text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((label_value, list(counts), total) for label_value, (counts, total) in self._series.items())
+        for label_value, counts, total in series:
+            label = _label(self.label, label_value)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(self.name, label + ',' if label else '', bound,
+                                                                cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _braces(label), total))
+            lines.append('{}_count{} {}'.format(self.name, _braces(label), cumulative))
+        return lines
+
+
+class Counter:
+    """
+    Running totals by one label
+    """
+    def __init__(self, name, help_text, label):
+        """
+        :param str name: Metric name, ending in _total
+        :param str help_text: Description shown by Prometheus
+        :param str label: Name of the label, e.g. 'handler', or None for a single series
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        """
+        :param label_value: Value of the label
+        :param amount: Amount to add
+        """
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        """
+        :return: List of lines in the Prometheus text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend('{}{} {}'.format(self.name, _braces(_label(self.label, label_value)), value)
+                     for label_value, value in values)
+        return lines
+
+
+class Gauge:
+    """
+    Current values by one label, read from a function of each label value when the metrics are scraped
+    """
+    def __init__(self, name, help_text, label):
+        """
+        :param str name: Metric name
+        :param str help_text: Description shown by Prometheus
+        :param str label: Name of the label, e.g. 'table'
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        # label value -> function returning the current value
+        self._values = dict()
+
+    def register(self, label_value, value):
+        """
+        :param label_value: Value of the label
+        :param value: Function returning the current value
+        """
+        self._values[label_value] = value
+
+    def render(self):
+        """
+        :return: List of lines in the Prometheus text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} gauge'.format(self.name)]
+        values = sorted((label_value, value()) for label_value, value in list(self._values.items()))
+        lines.extend('{}{} {}'.format(self.name, _braces(_label(self.label, label_value)), value)
+                     for label_value, value in values)
+        return lines
+
+
+class CacheRatios:
+    """
+    Hits, misses and hit ratio of the caches, read from their own counters when the metrics are scraped
+    """
+    def __init__(self):
+        # cache name -> function returning (hits, misses)
+        self._caches = dict()
+
+    def register(self, name, counts):
+        """
+        :param str name: Value of the cache label
+        :param counts: Function returning the cache's (hits, misses) so far
+        """
+        self._caches[name] = counts
+
+    def render(self):
+        """
+        :return: List of lines in the Prometheus text format
+        """
+        counts = sorted((name, counts()) for name, counts in list(self._caches.items()))
+        lines = ['# HELP bot_cache_hits_total Lookups answered from the cache',
+                 '# TYPE bot_cache_hits_total counter']
+        lines.extend('bot_cache_hits_total{{{}}} {}'.format(_label('cache', name), hits)
+                     for name, (hits, misses) in counts)
+        lines += ['# HELP bot_cache_misses_total Lookups that went to the database or upstream',
+                  '# TYPE bot_cache_misses_total counter']
+        lines.extend('bot_cache_misses_total{{{}}} {}'.format(_label('cache', name), misses)
+                     for name, (hits, misses) in counts)
+        lines += ['# HELP bot_cache_hit_ratio Hits over all lookups since the bot started',
+                  '# TYPE bot_cache_hit_ratio gauge']
+        lines.extend('bot_cache_hit_ratio{{{}}} {}'.format(_label('cache', name), hits / (hits + misses)
+                                                           if hits + misses else 0.0)
+                     for name, (hits, misses) in counts)
+        return lines
+
+
+handler_seconds = Histogram('bot_handler_seconds', 'Time spent in each dispatcher handler', 'handler')
+handler_errors = Counter('bot_handler_errors_total', 'Exceptions raised by each dispatcher handler', 'handler')
+job_seconds = Histogram('bot_job_seconds', 'Time spent in each job queue job', 'job')
+job_errors = Counter('bot_job_errors_total', 'Exceptions raised by each job queue job', 'job')
+datamall_seconds = Histogram('bot_datamall_request_seconds', 'Latency of each DataMall attempt', 'endpoint')
+datamall_errors = Counter('bot_datamall_errors_total', 'DataMall attempts that failed or timed out', 'endpoint')
+datamall_retries = Counter('bot_datamall_retries_total', 'Failed DataMall attempts that were tried again', 'endpoint')
+telegram_seconds = Histogram('bot_telegram_request_seconds', 'Latency of each Bot API call', 'method')
+telegram_errors = Counter('bot_telegram_errors_total', 'Bot API calls that raised', 'method')
+db_seconds = Histogram('bot_db_query_seconds', 'Time from checking out a connection to the last row', 'operation')
+db_errors = Counter('bot_db_errors_total', 'Database calls that raised', 'operation')
+db_pool_wait_seconds = Histogram('bot_db_pool_wait_seconds', 'Time waiting for a free pooled connection', None)
+db_reconnects = Counter('bot_db_reconnects_total', 'Connections found dropped by the server, at checkout or during '
+                        'a query', 'stage')
+write_behind_waiting = Gauge('bot_write_behind_waiting_rows', 'Rows waiting to be written behind', 'table')
+write_behind_rows = Counter('bot_write_behind_rows_total', 'Rows written behind', 'table')
+write_behind_failed_flushes = Counter('bot_write_behind_failed_flushes_total', 'Batches that could not be written '
+                                      'and were kept for the next flush', 'table')
+cache_ratios = CacheRatios()
+
+METRICS = [handler_seconds, handler_errors, job_seconds, job_errors, datamall_seconds, datamall_errors,
+           datamall_retries, telegram_seconds, telegram_errors, db_seconds, db_errors, db_pool_wait_seconds,
+           db_reconnects, write_behind_waiting, write_behind_rows, write_behind_failed_flushes, cache_ratios]
+
+
+def render():
+    """
+    :return: Every metric in the Prometheus text format
+    """
+    lines = list()
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def timed(seconds, errors, label_value, function):
+    """
+    Wrap a function to record its duration and count the exceptions it raises
+    :param Histogram seconds: Histogram of durations
+    :param Counter errors: Counter of exceptions
+    :param label_value: Value of the label
+    :param function: Function to wrap
+    :return: Wrapped function with the same name
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except DispatcherHandlerStop:
+            raise
+        except Exception:
+            errors.inc(label_value)
+            raise
+        finally:
+            seconds.observe(label_value, perf_counter() - start)
+    return wrapper
+
+
+def instrument_dispatcher(dispatcher):
+    """
+    Time the callback of every handler added to the dispatcher so far
+    :param telegram.ext.Dispatcher dispatcher: Dispatcher with all its handlers added
+    """
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = timed(handler_seconds, handler_errors, handler.callback.__name__, handler.callback)
+
+
+def job(callback):
+    """
+    :param callback: Job queue callback
+    :return: The callback, timed under its name
+    """
+    return timed(job_seconds, job_errors, callback.__name__, callback)
+
+
+class InstrumentedRequest(Request):
+    """
+    Request that times every Bot API call by method, for telegram.Bot(request=...)
+    """
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        start = perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        except Exception:
+            telegram_errors.inc(method)
+            raise
+        finally:
+            telegram_seconds.observe(method, perf_counter() - start)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+def start_server(port, host='127.0.0.1'):
+    """
+    Serve /metrics on a daemon thread
+    :param int port: Port to listen on
+    :param str host: Address to listen on, local only by default
+    :return: ThreadingHTTPServer, or None if the port could not be bound
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning('Metrics are not served, cannot listen on %s:%s: %s', host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+    return server
@@ -0,0 +1,178 @@
+"""
+Versioned schema upgrades for the bot's Postgres database.
+
+Every migration runs in its own transaction and is recorded in the schema_version table, so each one is applied
+exactly once. A transaction-level advisory lock stops two dynos from migrating at the same time.
+Run `python migrations.py` to migrate without starting the bot.
+"""
+import logging
+
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+# Key of the advisory lock held while migrating
+LOCK_ID = 7_234_001
+
+# Columns of the hand-made schedules table in the order the old code inserted them, followed by the five bus columns
+# that it only ever read and wrote by position
+SCHEDULE_COLUMNS = ('user_id', 'bus_stop_code', 'description', 'time', 'state')
+SCHEDULE_BUS_COLUMNS = 5
+
+
+def merge_bus_columns(cursor):
+    """
+    Copy the five bus columns of schedules, padded with 'None', into the buses array and drop them. Their names are
+    read from the catalogue by position, since the table was created by hand.
+    :param cursor: Cursor of the migration's transaction
+    """
+    cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema=current_schema() AND "
+                   "table_name='schedules' ORDER BY ordinal_position")
+    columns = [row[0] for row in cursor.fetchall()]
+    bus_columns = columns[len(SCHEDULE_COLUMNS):len(SCHEDULE_COLUMNS) + SCHEDULE_BUS_COLUMNS]
+    if (tuple(columns[:len(SCHEDULE_COLUMNS)]) != SCHEDULE_COLUMNS or len(bus_columns) != SCHEDULE_BUS_COLUMNS or
+            'buses' in columns):
+        raise RuntimeError('schedules has columns {}, expected {} followed by {} bus columns'
+                           .format(columns, list(SCHEDULE_COLUMNS), SCHEDULE_BUS_COLUMNS))
+    bus_columns = [sql.Identifier(column) for column in bus_columns]
+
+    cursor.execute("ALTER TABLE schedules ADD COLUMN buses TEXT[] NOT NULL DEFAULT '{}'")
+    cursor.execute(sql.SQL("UPDATE schedules SET buses=ARRAY(SELECT bus FROM unnest(ARRAY[{}]::TEXT[]) AS bus "
+                           "WHERE bus IS NOT NULL AND bus <> 'None')").format(sql.SQL(', ').join(bus_columns)))
+    cursor.execute(sql.SQL('ALTER TABLE schedules {}').format(
+        sql.SQL(', ').join(sql.SQL('DROP COLUMN {}').format(column) for column in bus_columns)))
+
+
+# (version, description, statements), a statement is SQL or a function of the migration's cursor
+MIGRATIONS = [
+    (1, 'Tables as first created by hand', [
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT NOT NULL,
+            bus_stop_code TEXT NOT NULL,
+            description TEXT,
+            new_description TEXT,
+            state TEXT NOT NULL DEFAULT '0',
+            UNIQUE (user_id, bus_stop_code))""",
+        """CREATE TABLE IF NOT EXISTS schedules (
+            user_id BIGINT NOT NULL,
+            bus_stop_code TEXT,
+            description TEXT,
+            time TEXT,
+            state TEXT NOT NULL DEFAULT '0',
+            bus1 TEXT, bus2 TEXT, bus3 TEXT, bus4 TEXT, bus5 TEXT,
+            UNIQUE (user_id, bus_stop_code, time, state))""",
+        """CREATE TABLE IF NOT EXISTS feedback (
+            user_id BIGINT NOT NULL,
+            user_feedback TEXT,
+            datetime TEXT,
+            state TEXT NOT NULL DEFAULT '0',
+            UNIQUE (user_id, user_feedback, datetime, state))""",
+        """CREATE TABLE IF NOT EXISTS bus_stop_code_history (
+            user_id BIGINT NOT NULL,
+            bus_stop_code TEXT NOT NULL,
+            description TEXT,
+            datetime TEXT,
+            UNIQUE (user_id, bus_stop_code))""",
+        """CREATE TABLE IF NOT EXISTS all_users (
+            user_id BIGINT PRIMARY KEY,
+            name TEXT,
+            receive_alerts TEXT NOT NULL DEFAULT 'Yes')""",
+        """CREATE TABLE IF NOT EXISTS mrt_updates (
+            message TEXT UNIQUE,
+            datetime TEXT)""",
+    ]),
+    (2, 'Typed columns and a bus array for schedules', [
+        # States become numbers
+        "ALTER TABLE users ALTER COLUMN state DROP DEFAULT",
+        "ALTER TABLE users ALTER COLUMN state TYPE SMALLINT USING state::TEXT::SMALLINT",
+        "ALTER TABLE users ALTER COLUMN state SET DEFAULT 0",
+        "ALTER TABLE feedback ALTER COLUMN state DROP DEFAULT",
+        "ALTER TABLE feedback ALTER COLUMN state TYPE SMALLINT USING state::TEXT::SMALLINT",
+        "ALTER TABLE feedback ALTER COLUMN state SET DEFAULT 0",
+        "ALTER TABLE schedules ALTER COLUMN state DROP DEFAULT",
+        "ALTER TABLE schedules ALTER COLUMN state TYPE SMALLINT USING state::TEXT::SMALLINT",
+        "ALTER TABLE schedules ALTER COLUMN state SET DEFAULT 0",
+        # '-' was written as a placeholder before the user had replied
+        "UPDATE schedules SET bus_stop_code=NULL WHERE bus_stop_code='-'",
+        # Three digit times used to be stored as the first two digits and the last two, e.g. '730' as '73:30'
+        "UPDATE schedules SET time='0' || substr(time, 1, 1) || ':' || substr(time, 4, 2) "
+        "WHERE time ~ '^[0-9]{2}:[0-9]{2}$' AND substr(time, 1, 2)::INTEGER >= 24",
+        "ALTER TABLE schedules ALTER COLUMN time TYPE TIME USING NULLIF(time::TEXT, '-')::TIME",
+        "UPDATE feedback SET user_feedback=NULL WHERE user_feedback='-'",
+        # Datetimes were written as Singapore local time
+        "ALTER TABLE feedback ALTER COLUMN datetime TYPE TIMESTAMPTZ "
+        "USING NULLIF(datetime::TEXT, '-')::TIMESTAMP AT TIME ZONE 'Asia/Singapore'",
+        "ALTER TABLE bus_stop_code_history ALTER COLUMN datetime TYPE TIMESTAMPTZ "
+        "USING NULLIF(datetime::TEXT, '-')::TIMESTAMP AT TIME ZONE 'Asia/Singapore'",
+        "ALTER TABLE mrt_updates ALTER COLUMN datetime TYPE TIMESTAMPTZ "
+        "USING NULLIF(datetime::TEXT, '-')::TIMESTAMP AT TIME ZONE 'Asia/Singapore'",
+        # An empty array means all buses
+        merge_bus_columns,
+    ]),
+    (3, 'Indexes for the conversation state, scheduled message and history lookups', [
+        # A user has at most one pending feedback and one pending row for each step of scheduling a message
+        "DELETE FROM feedback a USING feedback b WHERE a.state <> 0 AND a.user_id=b.user_id AND a.state=b.state "
+        "AND a.ctid < b.ctid",
+        "DELETE FROM schedules a USING schedules b WHERE a.state <> 0 AND a.user_id=b.user_id AND a.state=b.state "
+        "AND a.ctid < b.ctid",
+        "CREATE UNIQUE INDEX IF NOT EXISTS feedback_pending ON feedback (user_id) WHERE state <> 0",
+        "CREATE UNIQUE INDEX IF NOT EXISTS schedules_pending ON schedules (user_id, state) WHERE state <> 0",
+        "CREATE INDEX IF NOT EXISTS users_pending ON users (user_id) WHERE state <> 0",
+        "CREATE INDEX IF NOT EXISTS schedules_time ON schedules (time)",
+        "CREATE INDEX IF NOT EXISTS bus_stop_code_history_latest ON bus_stop_code_history (user_id, datetime DESC)",
+        "CREATE INDEX IF NOT EXISTS mrt_updates_latest ON mrt_updates (datetime DESC)",
+    ]),
+    (4, 'MRT alert broadcasts with progress', [
+        # One row per change of the TrainServiceAlerts content, the latest row holds the last seen content hash
+        """CREATE TABLE IF NOT EXISTS mrt_alert_broadcasts (
+            id SERIAL PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_user_id BIGINT,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            completed_at TIMESTAMPTZ)""",
+        "CREATE INDEX IF NOT EXISTS mrt_alert_broadcasts_unfinished ON mrt_alert_broadcasts (id) "
+        "WHERE completed_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS all_users_receive_alerts ON all_users (user_id) WHERE receive_alerts='Yes'",
+    ]),
+    (5, 'Telegram file_ids of uploaded static files', [
+        """CREATE TABLE IF NOT EXISTS media_files (
+            path TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            uploaded_at TIMESTAMPTZ NOT NULL DEFAULT now())""",
+    ]),
+]
+
+
+def migrate(db):
+    """
+    Apply every migration that has not been applied yet
+    :param database.Database db: Database to migrate
+    :return: Latest schema version
+    """
+    db.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL, "
+               "applied_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+    for version, description, statements in MIGRATIONS:
+        with db.transaction() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (LOCK_ID,))
+            cursor.execute('SELECT 1 FROM schema_version WHERE version=%s', (version,))
+            if cursor.fetchone() is not None:
+                continue
+            logger.info('Migrating database to version %s: %s', version, description)
+            for statement in statements:
+                if callable(statement):
+                    statement(cursor)
+                else:
+                    cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+                           (version, description))
+    return MIGRATIONS[-1][0]
+
+
+if __name__ == '__main__':
+    import database
+    logging.basicConfig(level=logging.INFO)
+    print('Database is at version {}'.format(migrate(database.connect())))
@@ -0,0 +1,106 @@
+"""
+Polls TrainServiceAlerts and broadcasts each new alert once to every user who opted in
+"""
+import hashlib
+import json
+import logging
+import threading
+
+from telegram import ParseMode
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(mrt_service):
+    """
+    :param dict mrt_service: Value of the TrainServiceAlerts response
+    :return: SHA-256 of the response with its keys sorted, so that the same alerts always hash the same
+    """
+    normalized = json.dumps(mrt_service, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class MrtAlertPoller:
+    """
+    Fetches the alerts once per tick and compares their content hash with the last one seen, which is kept in memory
+    and in the mrt_alert_broadcasts table. Every change is recorded there; changes that need to be announced are
+    sent to the subscribers in user_id order a page at a time, and the last user_id reached is saved after every
+    page so that a broadcast interrupted by a restart carries on where it stopped.
+    """
+    def __init__(self, db, broadcaster, fetch, render, quiet_message, page_size=200):
+        """
+        :param database.Database db: Database with the all_users and mrt_alert_broadcasts tables
+        :param broadcast.Broadcaster broadcaster: Sends the messages within Telegram's rate limits
+        :param fetch: Function that returns the value of the TrainServiceAlerts response
+        :param render: Function of the value of the response to the message for users
+        :param str quiet_message: Message when all train services work normally, which is not broadcast
+        :param int page_size: Number of users sent to between saving progress
+        """
+        self._db = db
+        self._broadcaster = broadcaster
+        self._fetch = fetch
+        self._render = render
+        self.quiet_message = quiet_message
+        self.page_size = page_size
+        self._last_hash = None
+        self._lock = threading.Lock()
+
+    def poll(self, bot):
+        """
+        Finish any interrupted broadcast, then fetch the alerts and broadcast them if they changed
+        :param bot: telegram.Bot
+        """
+        with self._lock:
+            self._resume(bot)
+
+            mrt_service = self._fetch()
+            new_hash = content_hash(mrt_service)
+            announced = None
+            if self._last_hash is None:
+                row = self._db.fetchone('SELECT content_hash FROM mrt_alert_broadcasts ORDER BY id DESC LIMIT 1')
+                self._last_hash = row[0] if row else ''
+                if row is None:
+                    # Alerts used to be recorded by message in mrt_updates
+                    row = self._db.fetchone('SELECT message FROM mrt_updates ORDER BY datetime DESC LIMIT 1')
+                    announced = row[0] if row else None
+            if new_hash == self._last_hash:
+                return
+
+            message = self._render(mrt_service)
+            # Going back to normal is recorded but not announced
+            skip = message == self.quiet_message or message == announced
+            broadcast_id = self._db.fetchone(
+                'INSERT INTO mrt_alert_broadcasts (content_hash, message, completed_at) VALUES (%s, %s, '
+                'CASE WHEN %s THEN now() END) RETURNING id', (new_hash, message, skip))[0]
+            self._last_hash = new_hash
+            if not skip:
+                logger.info('New MRT alert %s', broadcast_id)
+                self._send(bot, broadcast_id, message, None)
+
+    def _resume(self, bot):
+        for broadcast_id, message, last_user_id in self._db.fetchall(
+                'SELECT id, message, last_user_id FROM mrt_alert_broadcasts WHERE completed_at IS NULL ORDER BY id'):
+            logger.info('Resuming MRT alert %s after user %s', broadcast_id, last_user_id)
+            self._send(bot, broadcast_id, message, last_user_id)
+
+    def _send(self, bot, broadcast_id, message, last_user_id):
+        if last_user_id is None:
+            # Group chats have negative ids
+            last_user_id = -2 ** 63
+        total = self._db.fetchone("SELECT count(*) FROM all_users WHERE receive_alerts='Yes' AND user_id > %s",
+                                  (last_user_id,))[0]
+        done = 0
+        while True:
+            users = [row[0] for row in self._db.fetchall(
+                "SELECT user_id FROM all_users WHERE receive_alerts='Yes' AND user_id > %s ORDER BY user_id LIMIT %s",
+                (last_user_id, self.page_size))]
+            if not users:
+                break
+            result = self._broadcaster.send(bot, [(user_id, {'text': message, 'parse_mode': ParseMode.HTML})
+                                                  for user_id in users])
+            last_user_id = users[-1]
+            self._db.execute('UPDATE mrt_alert_broadcasts SET last_user_id=%s, sent=sent + %s, failed=failed + %s '
+                             'WHERE id=%s', (last_user_id, result.sent, result.failed + result.skipped, broadcast_id))
+            done += len(users)
+            logger.info('MRT alert %s: %s of %s users, %s', broadcast_id, done, total, result)
+        self._db.execute('UPDATE mrt_alert_broadcasts SET completed_at=now() WHERE id=%s', (broadcast_id,))
@@ -0,0 +1,136 @@
+"""
+Renders the bus timing messages. Every format is built from the same parsed arrivals (the result of
+shortcuts.get_bus_timing) with a single join, and the legend, footer and keyboards are built once.
+"""
+from datetime import datetime, timedelta
+from time import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Telegram does not send messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+LOAD_EMOJI = {'SEA': '🟢', 'SDA': '🟡', 'LSD': '🔴'}
+FEATURE_EMOJI = {'WAB': '♿'}
+
+# buttons_functions recognises bus timing messages by 'Wheel-chair Accessible'
+LEGEND = '🟢: Seats Available\n🟡: Standing Available\n🔴: Limited Seating\n♿: Wheel-chair Accessible\n\n'
+
+SHORT_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton('Refresh', callback_data='callback_refresh'),
+                                        InlineKeyboardButton('Detailed Format', callback_data='callback_format')]])
+LONG_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton('Refresh', callback_data='callback_refresh'),
+                                       InlineKeyboardButton('General Format', callback_data='callback_format')]])
+DASHBOARD_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton('Refresh', callback_data='favourites_dashboard')]])
+
+_FOOTERS = {display_format: LEGEND + '<b>Format:</b> {}\n<b>Updated:</b> '.format(display_format)
+            for display_format in ('General', 'Detailed', 'All Favourites')}
+_updated = [None, '']
+
+
+def updated_time():
+    """
+    :return: Current Singapore time as 'YYYY-MM-DD HH:MM', formatted once per minute
+    """
+    minute = int(time() // 60)
+    if _updated[0] != minute:
+        _updated[1] = (datetime.utcfromtimestamp(minute * 60) + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M')
+        _updated[0] = minute
+    return _updated[1]
+
+
+def footer(display_format):
+    """
+    :param str display_format: 'General', 'Detailed' or 'All Favourites'
+    :return: Legend, format and updated time at the end of a bus timing message
+    """
+    return _FOOTERS[display_format] + updated_time()
+
+
+def timing_text(timing):
+    """
+    :param timing: Minutes until the bus arrives, or 'No Estimation'/'Not In Operation ❌'
+    :return: e.g. '5mins', 'Arriving' or the text as it is
+    """
+    if type(timing) == str:
+        return timing
+    return '{}mins'.format(timing) if int(timing) > 1 else 'Arriving'
+
+
+def arrival_text(arrival):
+    """
+    :param arrival: [timing, load, feature] of one bus
+    :return: Timing followed by the load and feature emoji, e.g. '5mins🟢♿'
+    """
+    timing, load, feature = arrival
+    return timing_text(timing) + LOAD_EMOJI.get(load, load) + FEATURE_EMOJI.get(feature, feature)
+
+
+def next_bus_order(bus):
+    """
+    Sort key that puts the next bus to arrive first, then the buses without an estimate
+    :param bus: [bus number, next bus, second bus, third bus]
+    """
+    timing = bus[1][0]
+    return (1, timing) if type(timing) == str else (0, timing)
+
+
+def _header(bus_stop_name, bus_stop_code):
+    return '<b>Bus Stop: </b>{}\n<b>Bus Stop Code: </b>/{}\n\n'.format(bus_stop_name, bus_stop_code)
+
+
+def short_message(bus_timing, bus_selected_list=None):
+    """
+    :param bus_timing: (bus timings, Bus Stop Name, Bus Stop Code) from get_bus_timing
+    :param list bus_selected_list: Bus numbers to show, None or [] to show all the buses
+    :return: General format message showing the next bus of every service
+    """
+    bus_timings, bus_stop_name, bus_stop_code = bus_timing
+    buses = ['Bus /{}\n  -{}\n\n'.format(bus[0], arrival_text(bus[1]))
+             for bus in sorted(bus_timings, key=next_bus_order)
+             if not bus_selected_list or bus[0] in bus_selected_list]
+    return ''.join([_header(bus_stop_name, bus_stop_code)] + buses + [footer('General')])
+
+
+def long_message(bus_timing):
+    """
+    :param bus_timing: (bus timings, Bus Stop Name, Bus Stop Code) from get_bus_timing
+    :return: Detailed format message showing the next three buses of every service
+    """
+    bus_timings, bus_stop_name, bus_stop_code = bus_timing
+    buses = ['Bus /{}\n{}\n'.format(bus[0], ''.join('  -{}\n'.format(arrival_text(arrival)) for arrival in bus[1:]))
+             for bus in bus_timings]
+    return ''.join([_header(bus_stop_name, bus_stop_code)] + buses + [footer('Detailed')])
+
+
+def scheduled_message(bus_timing, bus_selected_list):
+    """
+    :param bus_timing: (bus timings, Bus Stop Name, Bus Stop Code) from get_bus_timing
+    :param list bus_selected_list: Bus numbers to show, [] to show all the buses
+    :return: General format message marked as a scheduled message
+    """
+    return '<b><u>This is a Scheduled Message</u></b>\n' + short_message(bus_timing, bus_selected_list)
+
+
+def dashboard_message(favourites, bus_timings):
+    """
+    :param favourites: List of (Bus Stop Code, name) of the favourite bus stops
+    :param dict bus_timings: Bus Stop Code to the result of get_bus_timing, missing if it could not be fetched
+    :return: One message with the next two buses of every service at every favourite bus stop
+    """
+    tail = footer('All Favourites')
+    parts, length = ['<b>All Favourites</b>\n\n'], len(tail) + 25
+    for bus_stop_code, name in favourites:
+        if bus_stop_code in bus_timings:
+            buses = ''.join('  /{}: {}\n'.format(bus[0], ', '.join(arrival_text(arrival) for arrival in bus[1:3]))
+                            for bus in bus_timings[bus_stop_code][0])
+        else:
+            buses = '  Bus timings are not available right now\n'
+        part = '<b>{}</b> (/{})\n{}\n'.format(name, bus_stop_code, buses)
+        # Stay within Telegram's message length
+        if length + len(part) > MAX_MESSAGE_LENGTH:
+            parts.append('...\n\n')
+            break
+        parts.append(part)
+        length += len(part)
+    parts.append(tail)
+    return ''.join(parts)
@@ -0,0 +1,95 @@
+"""
+In-memory index of scheduled messages by minute of the day
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def minute_of_day(schedule_time):
+    """
+    :param schedule_time: 'HH:MM' string or datetime.time
+    :return: Minutes after midnight
+    :raises ValueError: If the time is not between 00:00 and 23:59
+    """
+    if isinstance(schedule_time, str):
+        hour, minute = map(int, schedule_time.split(':')[:2])
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError('{!r} is not a time of day'.format(schedule_time))
+        return hour * 60 + minute
+    return schedule_time.hour * 60 + schedule_time.minute
+
+
+class ScheduleEntry:
+    """
+    A scheduled message: send the bus timings of a bus stop to a user
+    """
+    __slots__ = ('user_id', 'bus_stop_code', 'buses')
+
+    def __init__(self, user_id, bus_stop_code, buses):
+        self.user_id = user_id
+        self.bus_stop_code = bus_stop_code
+        # Empty tuple means all buses
+        self.buses = tuple(buses)
+
+
+class ScheduleWheel:
+    """
+    1,440 buckets, one per minute of the day, so that the per-minute tick does not need to query the database.
+    Built from the schedules table at startup and kept up to date as users add or remove schedules.
+    """
+    def __init__(self):
+        self._buckets = [list() for _ in range(MINUTES_PER_DAY)]
+        self._lock = threading.Lock()
+
+    def load(self, schedules):
+        """
+        Replace every bucket. Schedules whose time is not a time of day are logged and left out.
+        :param schedules: Iterable of (user_id, bus_stop_code, time, buses)
+        """
+        buckets = [list() for _ in range(MINUTES_PER_DAY)]
+        for user_id, bus_stop_code, schedule_time, buses in schedules:
+            try:
+                minute = minute_of_day(schedule_time)
+            except (ValueError, AttributeError):
+                logger.warning('Skipping schedule of user %s at %s, invalid time %r', user_id, bus_stop_code,
+                               schedule_time)
+                continue
+            buckets[minute].append(ScheduleEntry(user_id, bus_stop_code, buses))
+        with self._lock:
+            self._buckets = buckets
+
+    def add(self, user_id, bus_stop_code, schedule_time, buses):
+        """
+        :param user_id: Chat id of the user
+        :param str bus_stop_code: Bus Stop Code of the scheduled message
+        :param schedule_time: 'HH:MM' string or datetime.time
+        :param buses: Bus numbers to show, empty to show all the buses
+        """
+        with self._lock:
+            self._buckets[minute_of_day(schedule_time)].append(ScheduleEntry(user_id, bus_stop_code, buses))
+
+    def remove(self, user_id, schedule_time):
+        """
+        Remove all of a user's schedules at a time
+        :param user_id: Chat id of the user
+        :param schedule_time: 'HH:MM' string or datetime.time
+        """
+        minute = minute_of_day(schedule_time)
+        with self._lock:
+            self._buckets[minute] = [entry for entry in self._buckets[minute] if entry.user_id != user_id]
+
+    def due(self, minute):
+        """
+        :param int minute: Minutes after midnight
+        :return: List of ScheduleEntry to send at that minute
+        """
+        with self._lock:
+            return list(self._buckets[minute % MINUTES_PER_DAY])
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(bucket) for bucket in self._buckets)
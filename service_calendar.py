@@ -0,0 +1,77 @@
+"""
+Which timetable buses run on today in Singapore, and whether a bus service is running right now
+"""
+from datetime import datetime, timedelta
+
+import holidays
+
+# Index into RouteTimings.windows
+WEEKDAY = 0
+SATURDAY = 1
+SUNDAY = 2
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def singapore_now():
+    """
+    :return: Current Singapore time as a naive datetime
+    """
+    return datetime.utcnow() + timedelta(hours=8)
+
+
+class ServiceCalendar:
+    """
+    Public holidays are loaded once when the calendar is built, and the day types of the current Singapore day
+    and the day before are worked out once per day. Buses run on the Sunday timetable on public holidays.
+    """
+    def __init__(self, holiday_dates=None):
+        """
+        :param holiday_dates: Iterable of datetime.date, defaults to Singapore's public holidays from last year to
+        two years from now
+        """
+        if holiday_dates is None:
+            year = singapore_now().year
+            holiday_dates = holidays.Singapore(years=range(year - 1, year + 3)).keys()
+        self._holidays = frozenset(holiday_dates)
+        # (date, day type of that date, day type of the day before)
+        self._today = (None, None, None)
+
+    def day_type(self, date):
+        """
+        :param datetime.date date: Date in Singapore
+        :return: WEEKDAY, SATURDAY or SUNDAY
+        """
+        if date.weekday() == 6 or date in self._holidays:
+            return SUNDAY
+        if date.weekday() == 5:
+            return SATURDAY
+        return WEEKDAY
+
+    def _day_types(self, date):
+        today = self._today
+        if today[0] != date:
+            today = self._today = (date, self.day_type(date), self.day_type(date - timedelta(days=1)))
+        return today[1], today[2]
+
+    def is_operating(self, timings, now=None):
+        """
+        :param bus_index.RouteTimings timings: First and last buses of a service at a bus stop, or None if unknown
+        :param datetime now: Singapore time, defaults to the current time
+        :return: True if the service is running at that time, including buses after midnight that run on the
+        previous day's timetable
+        """
+        now = now or singapore_now()
+        minute = now.hour * 60 + now.minute
+        if timings is None:
+            # No timetable, assume the bus runs all day
+            return 0 < minute < MINUTES_PER_DAY - 1
+        today, yesterday = self._day_types(now.date())
+        window = timings.windows[today]
+        if window is not None and window[0] < minute < window[1]:
+            return True
+        window = timings.windows[yesterday]
+        return window is not None and window[0] < minute + MINUTES_PER_DAY < window[1]
+
+
+service_calendar = ServiceCalendar()
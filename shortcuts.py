@@ -1,88 +1,58 @@
 import os
 import re
-import requests
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram_messages import *
+from bus_index import bus_stop_registry, route_index, load_bus_index
+from geo import haversine
+from arrival_cache import ArrivalCache
+from datamall import datamall
+import render
+from arrival_times import decode_arrivals
+from service_calendar import service_calendar
 
-from math import cos, sin, asin, sqrt, radians
 from datetime import datetime, timedelta
-import holidays
 
 # Tokens for telegram and LTA API
 TOKEN = os.environ.get('TELEGRAM_TOKEN_KEY')
 LTA_TOKEN_KEY = os.environ.get('LTA_TOKEN_KEY')
 
+logger = logging.getLogger(__name__)
 
-def time_difference(bus_stop_code, bus_num, arrival_time):
+# Bus stops fetched at the same time, e.g. for scheduled messages
+bus_timing_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='bus_timing')
+
+# Bus arrivals are shared by everyone looking at the same bus stop for a few seconds
+arrival_cache = ArrivalCache(ttl=float(os.environ.get('ARRIVAL_CACHE_TTL', '15')),
+                             max_size=int(os.environ.get('ARRIVAL_CACHE_SIZE', '2048')))
+
+TRAINS_NORMAL_MSG = 'All Train Services Working Normally 👍'
+
+# Set IO_MODE=async to make DataMall calls as coroutines on one asyncio event loop instead of blocking threads.
+# Only get_many_bus_timings gains from it, a single call still blocks the handler's thread until it returns.
+ASYNC_IO = os.environ.get('IO_MODE') == 'async'
+# Seconds a handler waits on the event loop. A bus arrival fetch that takes longer still fills arrival_cache.
+ASYNC_TIMEOUT = float(os.environ.get('ASYNC_TIMEOUT', '10'))
+if ASYNC_IO:
+    from async_datamall import EventLoopThread, AsyncDataMallClient
+    event_loop = EventLoopThread()
+    async_datamall = AsyncDataMallClient(LTA_TOKEN_KEY)
+
+
+def time_difference(bus_stop_code, bus_num):
     """
-    Find the time difference between current time and bus arrival
+    Describe a bus without an arrival estimate from its timetable
     :param str bus_stop_code: Bus Stop Code of bus stop
     :param str bus_num: Bus Number
-    :param str arrival_time: Arrival time for bus to reach bus stop
-    :return: Difference in time in minutes/No Estimation/Not in Operation
+    :return: No Estimation/Not in Operation
     """
-    if arrival_time != '':
-        arrival_time = datetime.strptime(arrival_time.split('+')[0].replace('T', ' '), '%Y-%m-%d %H:%M:%S')
-        difference = round(((arrival_time - (datetime.utcnow() + timedelta(hours=8))).total_seconds() / 60.0))
-        return difference
-
+    # Bus is in operation, but arrival data not available: No Estimation
+    # Bus not in operation and arrival data not available: Not in Operation
+    if service_calendar.is_operating(route_index().timings(bus_num, bus_stop_code)):
+        return 'No Estimation'
     else:
-        # Bus is in operation, but arrival data not available: No Estimation
-        # Bus not in operation and arrival data not available: Not in Operation
-        day = datetime.today().weekday()
-        if datetime.now() in holidays.Singapore():
-            first_bus_index = 8
-            last_bus_index = 9
-        elif day < 5:
-            first_bus_index = 4
-            last_bus_index = 5
-        else:
-            first_bus_index = 6
-            last_bus_index = 7
-        with open('bus_routes.txt', 'r') as r:
-            first_bus_timing = '0000'
-            last_bus_timing = '1900-01-01 2359'
-            for bus in r.readlines():
-                attributes = bus.split(' | ', 9)
-                if attributes[0] == bus_num and attributes[2] == bus_stop_code:
-                    first_bus_timing = attributes[first_bus_index]
-                    last_bus_timing = attributes[last_bus_index]
-                    if attributes[last_bus_index] < '1200':
-                        last_bus_timing = '1900-01-02 {}'.format(last_bus_timing)
-                    elif attributes[last_bus_index] >= '1200':
-                        last_bus_timing = '1900-01-01 {}'.format(last_bus_timing)
-                break
-        time_format = '%H%M'
-        current_time = str(datetime.utcnow() + timedelta(hours=8)).split()[1][:5].replace(':', '')
-        if datetime.strptime(first_bus_timing, time_format) < datetime.strptime(current_time, time_format) < \
-                datetime.strptime(last_bus_timing, '%Y-%m-%d %H%M'):
-            return 'No Estimation'
-        else:
-            return 'Not In Operation ❌'
-
-
-def haversine(current_lat, current_lon, bus_stop_lat, bus_stop_lon):
-    """
-    Haversine Formula: Calculate the  circle distance between two points on Earth
-    :param str current_lat: Latitude of user's location
-    :param str current_lon: Longitude of user;s location
-    :param float bus_stop_lat: Latitude of bus stop
-    :param float bus_stop_lon: Longitude of bus stop
-    :return: Distance between user's current location and bus stop
-    """
-
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [current_lon, current_lat, bus_stop_lon, bus_stop_lat])
-
-    diff_lon = lon2 - lon1
-    diff_lat = lat2 - lat1
-    a = sin(diff_lat/2)**2 + cos(lat1) * cos(lat2) * sin(diff_lon/2)**2
-    c = 2 * asin(sqrt(a))
-
-    # Radius of earth in kilometers. Use 3956 for miles
-    r = 6371
-    return c * r
+        return 'Not In Operation ❌'
 
 
 def has_numbers(string):
@@ -94,77 +64,101 @@ def has_numbers(string):
     return bool(re.search(r'\d', string))
 
 
-def get_bus_timing(bus_stop_code):
+def fetch_bus_arrival(bus_stop_code):
+    """
+    Get the arrival data of all the buses at a bus stop from the LTA API
+    :param str bus_stop_code: Bus Stop Code of a bus stop
+    :return: List of services from the BusArrivalv2 response
+    """
+    return datamall.get('BusArrivalv2', {'BusStopCode': bus_stop_code})['Services']
+
+
+async def fetch_bus_arrival_async(bus_stop_code):
+    """
+    Same as fetch_bus_arrival, as a coroutine on the event loop
+    :param str bus_stop_code: Bus Stop Code of a bus stop
+    :return: List of services from the BusArrivalv2 response
+    """
+    return (await async_datamall.get('BusArrivalv2', {'BusStopCode': bus_stop_code}))['Services']
+
+
+def bus_arrival(bus_stop_code):
+    """
+    Same as fetch_bus_arrival, but served from arrival_cache while the last response is fresh
+    :param str bus_stop_code: Bus Stop Code of a bus stop
+    :return: List of services from the BusArrivalv2 response
+    """
+    if ASYNC_IO:
+        return event_loop.run(arrival_cache.get_async(bus_stop_code, fetch_bus_arrival_async), ASYNC_TIMEOUT)
+    return arrival_cache.get(bus_stop_code, fetch_bus_arrival)
+
+
+def get_bus_timing(bus_stop_code, all_buses=None):
     """
     Get all the bus timings of a bus stop
     :param bus_stop_code: Bus Stop Code of a bus stop
+    :param all_buses: Services from the BusArrivalv2 response if already fetched, otherwise they are fetched
     :returns: Bus timings of a bus stop, Bus Stop Name, Bus Stop Code
     """
-    url = "http://datamall2.mytransport.sg/ltaodataservice/BusArrivalv2?BusStopCode={}".format(bus_stop_code)
-    headers = {'AccountKey': LTA_TOKEN_KEY}
-    response = requests.get(url, headers=headers).json()
-    all_buses = response['Services']
-
-    bus_timings = list()
-    for bus in all_buses:
-        print(bus)
-        try:
-            bus_timings.append([bus['ServiceNo'],
-                                [time_difference(bus_stop_code, bus['ServiceNo'], bus['NextBus']['EstimatedArrival']),
-                                 bus['NextBus']['Load'],
-                                 bus['NextBus']['Feature']],
-                                [time_difference(bus_stop_code, bus['ServiceNo'], bus['NextBus2']['EstimatedArrival']),
-                                 bus['NextBus2']['Load'],
-                                 bus['NextBus2']['Feature']],
-                                [time_difference(bus_stop_code, bus['ServiceNo'], bus['NextBus3']['EstimatedArrival']),
-                                 bus['NextBus3']['Load'],
-                                 bus['NextBus3']['Feature']]])
-        except ValueError:
-            print('error')
-
-    with open('bus_stops.txt', 'r') as r:
-        for bus_stop in r.readlines():
-            number_code = bus_stop.split(' | ', 5)[0]
-            bus_stop_name = bus_stop.split(' | ', 5)[2]
-            if bus_stop_code == number_code:
-                break
+    if all_buses is None:
+        all_buses = bus_arrival(bus_stop_code)
+
+    bus_timings = [[bus_num] + [[time_difference(bus_stop_code, bus_num) if minutes is None else minutes, load, feature]
+                                for minutes, load, feature in arrivals]
+                   for bus_num, arrivals in decode_arrivals(all_buses)]
+
+    bus_stop = bus_stop_registry().get(bus_stop_code)
+    bus_stop_name = bus_stop.description if bus_stop else ''
     return bus_timings, bus_stop_name, bus_stop_code
 
 
+def get_many_bus_timings(bus_stop_codes):
+    """
+    Get the bus timings of many bus stops concurrently
+    :param bus_stop_codes: Bus Stop Codes of the bus stops
+    :return: Dict of Bus Stop Code to the result of get_bus_timing. Bus stops that could not be fetched are left out.
+    """
+    bus_stop_codes = list(bus_stop_codes)
+    if ASYNC_IO:
+        return get_many_bus_timings_async(bus_stop_codes)
+    futures = [bus_timing_executor.submit(get_bus_timing, bus_stop_code) for bus_stop_code in bus_stop_codes]
+    bus_timings = dict()
+    for bus_stop_code, future in zip(bus_stop_codes, futures):
+        try:
+            bus_timings[bus_stop_code] = future.result()
+        except Exception as e:
+            logger.warning('Could not get bus timings for %s: %r', bus_stop_code, e)
+    return bus_timings
+
+
+def get_many_bus_timings_async(bus_stop_codes):
+    """
+    Same as get_many_bus_timings, but every bus stop missing from arrival_cache is fetched at once on the event loop
+    :param list bus_stop_codes: Bus Stop Codes of the bus stops
+    :return: Dict of Bus Stop Code to the result of get_bus_timing. Bus stops that could not be fetched are left out.
+    """
+    # Each bus stop has its own timeout, so one slow bus stop only leaves itself out
+    responses = event_loop.run(arrival_cache.get_many_async(bus_stop_codes, fetch_bus_arrival_async, ASYNC_TIMEOUT))
+    bus_timings = dict()
+    for bus_stop_code, all_buses in zip(bus_stop_codes, responses):
+        if isinstance(all_buses, Exception):
+            logger.warning('Could not get bus timings for %s: %r', bus_stop_code, all_buses)
+            continue
+        try:
+            bus_timings[bus_stop_code] = get_bus_timing(bus_stop_code, all_buses)
+        except Exception as e:
+            logger.warning('Could not get bus timings for %s: %r', bus_stop_code, e)
+    return bus_timings
+
+
 def long_bus_timing_message(bus_stop_code):
     """
     Create detailed bus timing message for user in Telegram
     :param bus_stop_code: Bus Stop Code of a bus stop
     :returns: Bus Message, reply_markup, Bus Stop Name, Bus Stop Code
     """
-    bus_timings, bus_stop_name, bus_stop_code = get_bus_timing(bus_stop_code)
-    bus_message = '<b>Bus Stop: </b>{}\n<b>Bus Stop Code: </b>/{}\n\n'.format(bus_stop_name, bus_stop_code)
-    for bus in bus_timings:
-        for bus_timings in bus:
-            if isinstance(bus_timings, list):
-                if type(bus_timings[0]) == str:
-                    timing = bus_timings[0]
-                elif int(bus_timings[0]) > 1:
-                    timing = '{}mins'.format(bus_timings[0])
-                else:
-                    timing = 'Arriving'
-                bus_message += '  -{}{}{}\n'.format(timing,
-                                                    bus_timings[1].replace('SEA', '🟢').replace('SDA', '🟡').replace(
-                                                        'LSD', '🔴'), bus_timings[2].replace('WAB', '♿'))
-            else:
-                # Bus Number
-                bus_message += 'Bus /{}\n'.format(bus_timings)
-        bus_message += '\n'
-    bus_message += '🟢: Seats Available\n🟡: Standing Available\n🔴: Limited Seating\n♿: Wheel-chair Accessible\n\n' \
-                   '<b>Format:</b> Detailed\n<b>Updated:</b> {}'.format(str(datetime.utcnow() + timedelta(hours=8))
-                                                                        .rsplit(':', 1)[0])
-    keyboard = [
-        [InlineKeyboardButton('Refresh', callback_data='callback_refresh'),
-         InlineKeyboardButton('General Format', callback_data='callback_format')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    return bus_message, reply_markup, bus_stop_name, bus_stop_code
+    bus_timing = get_bus_timing(bus_stop_code)
+    return render.long_message(bus_timing), render.LONG_KEYBOARD, bus_timing[1], bus_timing[2]
 
 
 def short_bus_timing_message(bus_stop_code):
@@ -173,78 +167,59 @@ def short_bus_timing_message(bus_stop_code):
     :param bus_stop_code: Bus Stop Code of a bus stop
     :returns: Bus Message, reply_markup, Bus Stop Name, Bus Stop Code
     """
-    bus_timings, bus_stop_name, bus_stop_code = get_bus_timing(bus_stop_code)
-
-    bus_message = '<b>Bus Stop: </b>{}\n<b>Bus Stop Code: </b>/{}\n\n'.format(bus_stop_name, bus_stop_code)
-    bus_timings.sort(key=lambda x: x[1])
-
-    for bus in bus_timings:
-        # Bus Number
-        bus_message += 'Bus /{}\n'.format(bus[0])
-        if type(bus[1][0]) == str:
-            timing = bus[1][0]
-        elif int(bus[1][0]) > 1:
-            timing = '{}mins'.format(bus[1][0])
-        else:
-            timing = 'Arriving'
-        bus_message += '  -{}{}{}\n\n'.format(timing, bus[1][1].replace('SEA', '🟢').replace('SDA', '🟡').
-                                              replace('SEA', '🔴'), bus[1][2].replace('WAB', '♿'))
-
-    bus_message += '🟢: Seats Available\n🟡: Standing Available\n🔴: Limited Seating\n♿: Wheel-chair Accessible\n\n' \
-                   '<b>Format:</b> General\n<b>Updated:</b> {}'.format(str(datetime.utcnow() + timedelta(hours=8))
-                                                                       .rsplit(':', 1)[0])
-    keyboard = [
-        [InlineKeyboardButton('Refresh', callback_data='callback_refresh'),
-         InlineKeyboardButton('Detailed Format', callback_data='callback_format')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    return bus_message, reply_markup, bus_stop_name, bus_stop_code
-
-
-def scheduled_bus_timing_format(bus_stop_code, bus_selected_list):
-    bus_timings, bus_stop_name, bus_stop_code = get_bus_timing(bus_stop_code)
-
-    bus_message = '<b><u>This is a Scheduled Message</u></b>\n' \
-                  '<b>Bus Stop: </b>{}\n<b>Bus Stop Code: </b>/{}\n\n'.format(bus_stop_name, bus_stop_code)
-
-    bus_timings.sort(key=lambda x: x[1])
-    for bus in bus_timings:
-        # Bus Number
-        # To make sure bus is inside the selected list or nothing is being selected(default option-ALL BUS)
-        if bus_selected_list == [] or bus[0] in bus_selected_list:
-            bus_message += 'Bus /{}\n'.format(bus[0])
-            if type(bus[1][0]) == str:
-                timing = bus[1][0]
-            elif int(bus[1][0]) > 1:
-                timing = '{}mins'.format(bus[1][0])
-            else:
-                timing = 'Arriving'
-            bus_message += '  -{}{}{}\n\n'.format(timing, bus[1][1].replace('SEA', '🟢').replace('SDA', '🟡').
-                                                  replace('SEA', '🔴'), bus[1][2].replace('WAB', '♿'))
-
-    bus_message += '🟢: Seats Available\n🟡: Standing Available\n🔴: Limited Seating\n♿: Wheel-chair Accessible\n\n' \
-                   '<b>Format:</b> General\n<b>Updated:</b> {}'.format(str(datetime.utcnow() + timedelta(hours=8))
-                                                                       .rsplit(':', 1)[0])
-    keyboard = [
-        [InlineKeyboardButton('Refresh', callback_data='callback_refresh'),
-         InlineKeyboardButton('Detailed Format', callback_data='callback_format')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    return bus_message, reply_markup, bus_stop_name, bus_stop_code
+    bus_timing = get_bus_timing(bus_stop_code)
+    return render.short_message(bus_timing), render.SHORT_KEYBOARD, bus_timing[1], bus_timing[2]
+
+
+def favourites_dashboard_message(favourites):
+    """
+    Create one message with the next bus timings of all the user's favourite bus stops, fetched concurrently
+    :param favourites: List of (Bus Stop Code, name) of the favourite bus stops
+    :returns: Bus Message, reply_markup
+    """
+    bus_timings = get_many_bus_timings(bus_stop_code for bus_stop_code, name in favourites)
+    return render.dashboard_message(favourites, bus_timings), render.DASHBOARD_KEYBOARD
+
+
+def scheduled_bus_timing_format(bus_stop_code, bus_selected_list, bus_timing=None):
+    """
+    Create scheduled bus timing message for user in Telegram
+    :param bus_stop_code: Bus Stop Code of a bus stop
+    :param list bus_selected_list: Bus numbers to show, or [] to show all the buses
+    :param bus_timing: Result of get_bus_timing for the bus stop if it has already been fetched
+    :returns: Bus Message, reply_markup, Bus Stop Name, Bus Stop Code
+    """
+    bus_timing = bus_timing or get_bus_timing(bus_stop_code)
+    bus_message = render.scheduled_message(bus_timing, bus_selected_list)
+    return bus_message, render.SHORT_KEYBOARD, bus_timing[1], bus_timing[2]
+
+
+def fetch_mrt_alerts():
+    """
+    :return: Value of the TrainServiceAlerts response
+    """
+    if ASYNC_IO:
+        response = event_loop.run(async_datamall.get('TrainServiceAlerts'), ASYNC_TIMEOUT)
+    else:
+        response = datamall.get('TrainServiceAlerts')
+    return response['value']
 
 
 def get_mrt_alerts():
-    url = 'http://datamall2.mytransport.sg/ltaodataservice/TrainServiceAlerts'
-    headers = {'AccountKey': LTA_TOKEN_KEY}
-    response = requests.get(url, headers=headers).json()
+    return mrt_alerts_message(fetch_mrt_alerts())
 
-    mrt_service = response['value']
+
+def mrt_alerts_message(mrt_service):
+    """
+    :param dict mrt_service: Value of the TrainServiceAlerts response
+    :return: Message describing the train disruptions, or TRAINS_NORMAL_MSG
+    """
     status = mrt_service['Status']
     # affected_segments and messages will be [] if there is no alert
     affected_segments = mrt_service['AffectedSegments']
     messages = mrt_service['Message']
     if status == 1 and affected_segments == [] and messages == []:
-        return 'All Train Services Working Normally 👍'
+        return TRAINS_NORMAL_MSG
 
     if affected_segments:
         affected_segments_msg = '<b>Train Disruption 😫:</b>\n'
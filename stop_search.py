@@ -0,0 +1,129 @@
+"""
+Trigram index over bus stop road names and descriptions for free-text location queries
+"""
+from collections import Counter
+from difflib import SequenceMatcher
+from heapq import nlargest
+
+# Similarity ratio must be above 75% for a road name/bus stop name to be accepted
+MIN_RATIO = 0.75
+
+
+def trigrams(text):
+    """
+    :param str text: Lowercase text
+    :return: Set of 3 character substrings of the text padded with spaces
+    """
+    padded = ' {} '.format(text)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class StopSearchIndex:
+    """
+    Inverted index from trigrams to the distinct road names and descriptions of bus stops
+    """
+    def __init__(self, bus_stops):
+        self._bus_stops = tuple(bus_stops)
+
+        text_ids = dict()
+        self._texts, self._text_stops, self._char_counts = list(), list(), list()
+        self._postings = dict()
+        for index, bus_stop in enumerate(self._bus_stops):
+            for text in (bus_stop.road_name.lower(), bus_stop.description.lower()):
+                text_id = text_ids.get(text)
+                if text_id is None:
+                    text_id = text_ids[text] = len(self._texts)
+                    grams = trigrams(text)
+                    self._texts.append(text)
+                    self._text_stops.append(list())
+                    self._char_counts.append(Counter(text))
+                    for gram in grams:
+                        self._postings.setdefault(gram, list()).append(text_id)
+                if not self._text_stops[text_id] or self._text_stops[text_id][-1] != index:
+                    self._text_stops[text_id].append(index)
+
+    def search(self, query, limit=20):
+        """
+        Rank bus stops by how well their road name or description matches the query.
+        Substring matches come first (tighter matches higher), then similarity ratios above MIN_RATIO.
+        :param str query: User's message
+        :param int limit: Maximum number of bus stops to return
+        :return: List of BusStop, best match first
+        """
+        query = query.lower()
+        grams = trigrams(query)
+        shared = dict()
+        for gram in grams:
+            for text_id in self._postings.get(gram, ()):
+                shared[text_id] = shared.get(text_id, 0) + 1
+
+        scores, candidates = dict(), list()
+        query_counts = Counter(query)
+        for text_id, count in shared.items():
+            text = self._texts[text_id]
+            # A substring of the text must share every one of its inner trigrams with it
+            if count >= len(grams) - 2 and query in text:
+                scores[text_id] = 1 + len(query) / len(text)
+            else:
+                # Same upper bound on the ratio as SequenceMatcher.quick_ratio, from the characters in common
+                text_counts = self._char_counts[text_id]
+                common = sum(min(n, text_counts[char]) for char, n in query_counts.items())
+                bound = 2 * common / (len(query) + len(text))
+                if bound > MIN_RATIO:
+                    candidates.append((bound, text_id))
+
+        best = dict()
+        for text_id, score in scores.items():
+            self._add_score(best, text_id, score)
+        # Align the candidates with the highest bound first, until no candidate left can make the top `limit`
+        threshold = self._threshold(best, limit)
+        candidates.sort(key=lambda candidate: -candidate[0])
+        for bound, text_id in candidates:
+            if bound < threshold:
+                break
+            ratio = SequenceMatcher(None, query, self._texts[text_id]).ratio()
+            if ratio > MIN_RATIO:
+                self._add_score(best, text_id, ratio)
+                threshold = self._threshold(best, limit)
+
+        ranked = sorted(best, key=lambda index: (-best[index], index))
+        return [self._bus_stops[index] for index in ranked[:limit]]
+
+    def _add_score(self, best, text_id, score):
+        for index in self._text_stops[text_id]:
+            if score > best.get(index, 0):
+                best[index] = score
+
+    @staticmethod
+    def _threshold(best, limit):
+        # Score a candidate has to beat to be among the `limit` best bus stops
+        if len(best) < limit:
+            return MIN_RATIO
+        return max(MIN_RATIO, nlargest(limit, best.values())[-1])
+
+    def search_compat(self, query, limit=21):
+        """
+        The original linear scan: the first bus stops in file order whose road name or description contains the
+        query or has a similarity ratio above MIN_RATIO. Each distinct text is only aligned once per query and the
+        cheap upper bounds of SequenceMatcher are checked before the full ratio.
+        :param str query: User's message
+        :param int limit: Maximum number of bus stops to return
+        :return: List of BusStop in file order
+        """
+        query = query.lower()
+        matches = dict()
+        possible_locations = list()
+        for index, bus_stop in enumerate(self._bus_stops):
+            for text in (bus_stop.road_name.lower(), bus_stop.description.lower()):
+                matched = matches.get(text)
+                if matched is None:
+                    matcher = SequenceMatcher(None, query, text)
+                    matched = matches[text] = query in text or (matcher.real_quick_ratio() > MIN_RATIO and
+                                                                matcher.quick_ratio() > MIN_RATIO and
+                                                                matcher.ratio() > MIN_RATIO)
+                if matched:
+                    possible_locations.append(bus_stop)
+                    break
+            if len(possible_locations) >= limit:
+                break
+        return possible_locations
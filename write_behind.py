@@ -0,0 +1,125 @@
+"""
+Write-behind buffer for upserts that handlers should not wait on, e.g. bus_stop_code_history and all_users
+"""
+import atexit
+import logging
+import threading
+
+from psycopg2.extras import execute_values
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedUpsert:
+    """
+    Rows waiting to be written by one INSERT ... VALUES %s statement. Rows with the same key are merged so that the
+    latest one wins, since one statement cannot upsert the same row twice.
+    """
+    def __init__(self, statement, key):
+        """
+        :param str statement: INSERT with a single VALUES %s placeholder for execute_values
+        :param key: Function of a row to the columns of the ON CONFLICT target
+        """
+        self.statement = statement
+        self.key = key
+        self.rows = dict()
+
+
+class WriteBehind:
+    """
+    Gathers rows in memory and writes them in batches with execute_values from a background thread, every
+    `interval` seconds or as soon as a table has `max_rows` rows waiting. A batch that fails is kept for the next
+    flush unless newer rows replaced it.
+    """
+    def __init__(self, db, interval=2.0, max_rows=500):
+        """
+        :param database.Database db: Database to write to
+        :param float interval: Seconds between flushes
+        :param int max_rows: Number of rows waiting in a table that triggers a flush straight away
+        """
+        self._db = db
+        self.interval = interval
+        self.max_rows = max_rows
+        self._tables = dict()
+        self._lock = threading.Lock()
+        # Held while writing, so that flush() returns only after rows taken by another thread are written
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    def register(self, name, statement, key):
+        """
+        :param str name: Name used with put() and flush(), usually the table name
+        :param str statement: INSERT with a single VALUES %s placeholder
+        :param key: Function of a row to the columns of the ON CONFLICT target
+        """
+        table = self._tables[name] = BatchedUpsert(statement, key)
+        metrics.write_behind_waiting.register(name, lambda: len(table.rows))
+
+    def put(self, name, row):
+        """
+        Queue a row to be written without waiting for the database
+        :param str name: Name the statement was registered with
+        :param tuple row: Values for the statement
+        """
+        table = self._tables[name]
+        with self._lock:
+            table.rows[table.key(row)] = row
+            full = len(table.rows) >= self.max_rows
+        if self._thread is None or self._closed:
+            # Not flushing in the background, e.g. in a script or after close(), so write straight away
+            self.flush(name)
+        elif full:
+            self._wake.set()
+
+    def flush(self, name=None):
+        """
+        Write the rows waiting for one table, or for every table. Call before reading rows that may still be
+        waiting, to read your own writes.
+        :param str name: Name the statement was registered with, None for every table
+        """
+        names = list(self._tables) if name is None else [name]
+        with self._flush_lock:
+            for name in names:
+                table = self._tables[name]
+                with self._lock:
+                    rows, table.rows = table.rows, dict()
+                if not rows:
+                    continue
+                try:
+                    with self._db.transaction() as cursor:
+                        execute_values(cursor, table.statement, list(rows.values()), page_size=self.max_rows)
+                except Exception:
+                    logger.exception('Could not write %s rows to %s', len(rows), name)
+                    metrics.write_behind_failed_flushes.inc(name)
+                    with self._lock:
+                        for key, row in rows.items():
+                            table.rows.setdefault(key, row)
+                else:
+                    metrics.write_behind_rows.inc(name, len(rows))
+
+    def start(self):
+        """
+        Start flushing in the background, and flush whatever is left when the process exits
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write_behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        """
+        Stop the background thread and write the rows that are left
+        """
+        self._closed = True
+        self._wake.set()
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()